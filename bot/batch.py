@@ -0,0 +1,158 @@
+"""
+Векторизованный пересчет итогов для всей таблицы user_data.
+
+Запуск из консоли после изменения цен:
+    python batch.py
+"""
+import logging
+import time
+import numpy as np
+from sqlalchemy import select, update
+from coefficients import load_cost_coefficients
+from database import Session
+from models import UserData
+
+# Стоимость лицензии сотрудника для тарифов с фиксированной ценой,
+# для остальных берется LicenseCosts.employee_license_cost
+EMPLOYEE_LICENSE_COSTS = {'lite': 500, 'enterprise': 600}
+
+# Размер пачки для массового обновления строк
+UPDATE_CHUNK_SIZE = 5000
+
+INPUT_COLUMNS = (
+    UserData.id,
+    UserData.employee_count,
+    UserData.hr_specialist_count,
+    UserData.documents_per_employee,
+    UserData.pages_per_document,
+    UserData.turnover_percentage,
+    UserData.working_minutes_per_month,
+    UserData.average_salary,
+    UserData.courier_delivery_cost,
+    UserData.hr_delivery_percentage,
+    UserData.license_type,
+)
+
+
+def compute_batch(columns, coefficients):
+    """
+    Считает те же показатели, что и calculations.py, сразу для массива
+    анкет.
+
+    :param columns: Словарь {имя поля UserData: numpy-массив}
+    :param coefficients: Снимок цен CostCoefficients
+    :return: Словарь numpy-массивов с результатами расчетов
+    """
+    paper = coefficients.paper
+    operations = coefficients.operations
+    license_costs = coefficients.license
+
+    employee_count = columns['employee_count']
+    documents_per_year = employee_count * (
+        columns['documents_per_employee'] * (
+            1 + columns['turnover_percentage'] / 100))
+    pages_per_year = documents_per_year * columns['pages_per_document']
+
+    total_paper_costs = pages_per_year * (
+        paper.page_cost + paper.printing_cost +
+        paper.storage_cost + paper.rent_cost)
+
+    hr_delivery_percentage = np.nan_to_num(columns['hr_delivery_percentage'])
+    total_logistics_costs = columns['courier_delivery_cost'] * (
+        hr_delivery_percentage / 100 * documents_per_year)
+
+    working_minutes = np.where(
+        np.isnan(columns['working_minutes_per_month']),
+        10080, columns['working_minutes_per_month'])
+    cost_per_minute = columns['average_salary'] / working_minutes
+    total_operations_costs = (
+        operations.time_of_printing + operations.tome_of_archiving +
+        operations.time_of_signing) * cost_per_minute * documents_per_year
+
+    license_type = columns['license_type']
+    employee_license_cost = np.full(
+        len(license_type), license_costs.employee_license_cost, dtype=float)
+    for name, cost in EMPLOYEE_LICENSE_COSTS.items():
+        employee_license_cost[license_type == name] = cost
+    total_license_costs = (
+        license_costs.main_license_cost +
+        license_costs.hr_license_cost * columns['hr_specialist_count'] +
+        employee_license_cost * employee_count)
+
+    return {
+        'documents_per_year': documents_per_year,
+        'pages_per_year': pages_per_year,
+        'total_paper_costs': total_paper_costs,
+        'total_logistics_costs': total_logistics_costs,
+        'total_operations_costs': total_operations_costs,
+        'total_license_costs': total_license_costs,
+    }
+
+
+def load_columns(session):
+    """
+    Читает входные поля всех анкет в колонки numpy (NULL -> nan).
+    """
+    rows = session.execute(select(*INPUT_COLUMNS)).all()
+    columns = {}
+    for index, column in enumerate(INPUT_COLUMNS):
+        values = [row[index] for row in rows]
+        if column.key == 'license_type':
+            columns[column.key] = np.array(
+                [value or 'standard' for value in values], dtype=object)
+        elif column.key == 'id':
+            columns[column.key] = np.array(values, dtype=np.int64)
+        else:
+            columns[column.key] = np.array(values, dtype=float)
+    return columns
+
+
+def recompute_all_totals(coefficients):
+    """
+    Пересчитывает total_*_costs для всех заполненных анкет по текущим
+    ценам и записывает их массовым UPDATE по первичному ключу.
+
+    :return: (число обновленных строк, затраченное время в секундах)
+    """
+    started = time.perf_counter()
+    with Session() as session:
+        columns = load_columns(session)
+        results = compute_batch(columns, coefficients)
+
+        # Незаполненные анкеты (NULL в обязательных полях) пропускаем
+        valid = np.ones(len(columns['id']), dtype=bool)
+        for name in ('total_paper_costs', 'total_logistics_costs',
+                     'total_operations_costs', 'total_license_costs'):
+            valid &= ~np.isnan(results[name])
+
+        ids = columns['id'][valid].tolist()
+        totals = {
+            name: results[name][valid].tolist()
+            for name in ('total_paper_costs', 'total_logistics_costs',
+                         'total_operations_costs', 'total_license_costs')
+        }
+        for start in range(0, len(ids), UPDATE_CHUNK_SIZE):
+            end = start + UPDATE_CHUNK_SIZE
+            session.execute(update(UserData), [
+                {
+                    'id': ids[i],
+                    'total_paper_costs': totals['total_paper_costs'][i],
+                    'total_logistics_costs':
+                        totals['total_logistics_costs'][i],
+                    'total_operations_costs':
+                        totals['total_operations_costs'][i],
+                    'total_license_costs': totals['total_license_costs'][i],
+                }
+                for i in range(start, min(end, len(ids)))
+            ])
+        session.commit()
+
+    elapsed = time.perf_counter() - started
+    logging.info(
+        f"Пересчитано анкет: {len(ids)} за {elapsed:.2f} с")
+    return len(ids), elapsed
+
+
+if __name__ == '__main__':
+    updated, elapsed = recompute_all_totals(load_cost_coefficients())
+    print(f"Пересчитано анкет: {updated} за {elapsed:.2f} с")
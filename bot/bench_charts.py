@@ -0,0 +1,90 @@
+"""
+Сравнение отрисовки графика расходов через matplotlib и Pillow.
+
+Каждый вариант запускается в отдельном чистом процессе, чтобы
+замеры памяти не влияли друг на друга.
+
+Запуск из папки bot:
+    python bench_charts.py --count 200
+"""
+import argparse
+import multiprocessing
+import random
+import resource
+import statistics
+import time
+
+RENDERERS = ('matplotlib', 'pillow')
+
+
+def _max_rss_mb():
+    # В Linux ru_maxrss - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(renderer, count, seed, output):
+    baseline = _max_rss_mb()
+    started = time.perf_counter()
+    if renderer == 'pillow':
+        from chart_pillow import render_cost_graph
+    else:
+        from graph import render_cost_graph
+    import_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    png = render_cost_graph(1_234_567, 345_678)
+    first_seconds = time.perf_counter() - started
+    if output:
+        with open(f'bench-{renderer}.png', 'wb') as file:
+            file.write(png)
+
+    rng = random.Random(seed)
+    timings, sizes = [], []
+    for _ in range(count):
+        current = rng.uniform(1e4, 5e7)
+        kedo = rng.uniform(1e4, current)
+        started = time.perf_counter()
+        png = render_cost_graph(current, kedo)
+        timings.append(time.perf_counter() - started)
+        sizes.append(len(png))
+
+    timings.sort()
+    return {
+        'renderer': renderer,
+        'import_ms': import_seconds * 1000,
+        'first_ms': first_seconds * 1000,
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[int(len(timings) * 0.95) - 1] * 1000,
+        'rss_mb': _max_rss_mb() - baseline,
+        'png_kb': statistics.mean(sizes) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--output', action='store_true',
+        help='Сохранить пример графика каждого варианта в bench-*.png')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for renderer in RENDERERS:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(
+                _measure, (renderer, args.count, args.seed, args.output)))
+
+    print(f"Графиков на вариант: {args.count}")
+    print(f"{'':<12}{'импорт, мс':>12}{'первый, мс':>12}{'p50, мс':>10}"
+          f"{'p95, мс':>10}{'RSS, МБ':>10}{'PNG, КБ':>10}")
+    for result in results:
+        print(f"{result['renderer']:<12}{result['import_ms']:>12.1f}"
+              f"{result['first_ms']:>12.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['rss_mb']:>10.1f}"
+              f"{result['png_kb']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
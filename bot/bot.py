@@ -1,27 +1,159 @@
+import time
+
+# Время запуска процесса - для отчета о длительности этапов старта
+STARTED_AT = time.perf_counter()
+
 import asyncio
+import logging
+import os
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from decouple import Config, RepositoryEnv
 from database import init_db
-from handlers import register_handlers
+from coefficients import reload_cost_coefficients
+from handlers import register_handlers, notifier
+from storage import SQLiteStorage
+from graph import shutdown_render_pool, warm_up_render_pool
+from webhook import run_webhook
+from cluster import run_cluster
+from crm import crm_sender
+from metrics import setup_metrics, instrument_bot, metrics_server
+from notifications import CHAT_SEND_INTERVAL
+from throttling import ThrottlingMiddleware
 
 config = Config(RepositoryEnv('.env'))
 BOT_TOKEN = config('BOT_TOKEN')
+# sqlite - анкеты переживают перезапуск, memory - хранятся только в памяти
+FSM_STORAGE = config('FSM_STORAGE', default='sqlite')
+# Через сколько секунд без активности незавершенная анкета удаляется
+FSM_STATE_TTL = config('FSM_STATE_TTL', default=24 * 60 * 60, cast=int)
+# polling - long polling, webhook - встроенный aiohttp-сервер,
+# cluster - вебхук с обработкой в нескольких процессах
+BOT_MODE = config('BOT_MODE', default='polling')
+WEBHOOK_URL = config('WEBHOOK_URL', default='')
+WEBHOOK_PATH = config('WEBHOOK_PATH', default='/webhook')
+WEBHOOK_HOST = config('WEBHOOK_HOST', default='0.0.0.0')
+WEBHOOK_PORT = config('WEBHOOK_PORT', default=8080, cast=int)
+WEBHOOK_SECRET = config('WEBHOOK_SECRET', default='')
+# Число процессов-воркеров и порт первого из них в режиме cluster
+WORKERS = config('WORKERS', default=os.cpu_count() or 1, cast=int)
+WORKER_BASE_PORT = config('WORKER_BASE_PORT', default=8081, cast=int)
+# Прогревать ли процессы отрисовки графиков в фоне после старта
+WARMUP = config('WARMUP', default=True, cast=bool)
 
+_background_tasks = set()
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
+
+class StartupTimer:
+    """
+    Замеряет длительность этапов запуска бота.
+    """
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self._last = started_at
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self):
+        total = self._last - self.started_at
+        phases = ', '.join(
+            f"{name} {seconds:.3f} с" for name, seconds in self.phases)
+        return f"Бот запущен за {total:.3f} с: {phases}"
+
+
+async def warm_up():
+    started = time.perf_counter()
+    try:
+        await warm_up_render_pool()
+    except Exception as e:
+        logging.error(f"Ошибка при прогреве отрисовки графиков: {e}")
+        return
+    print(f"Прогрев отрисовки графиков: {time.perf_counter() - started:.3f} с")
+
+
+async def start_warm_up():
+    # Прогрев идет в фоне и не задерживает начало приема обновлений
+    task = asyncio.create_task(warm_up())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def create_dispatcher(primary=True):
+    """
+    :param primary: Запускать ли фоновые задачи, которые должны работать
+        в единственном экземпляре (в режиме cluster - только в воркере 0)
+    """
+    if FSM_STORAGE == 'memory':
+        storage = MemoryStorage()
+    else:
+        storage = SQLiteStorage(ttl=FSM_STATE_TTL)
     dp = Dispatcher(storage=storage)
 
+    # Регистрация обработчиков
+    register_handlers(dp)
+    setup_metrics(dp)
+    # После счетчика обновлений, чтобы отброшенные тоже учитывались
+    dp.update.outer_middleware(ThrottlingMiddleware())
+
+    if BOT_MODE == 'cluster':
+        # Уведомления в чат менеджеров отправляет каждый воркер, поэтому
+        # пауза растягивается, чтобы вместе они не превысили лимит чата
+        notifier.send_interval = CHAT_SEND_INTERVAL * WORKERS
+    if WARMUP:
+        dp.startup.register(start_warm_up)
+    if primary:
+        dp.startup.register(crm_sender.start)
+        dp.shutdown.register(crm_sender.stop)
+    return dp
+
+
+async def main():
+    timer = StartupTimer(STARTED_AT)
+    timer.mark('импорт')
+    bot = instrument_bot(Bot(token=BOT_TOKEN))
+
     # Инициализация базы данных
     init_db()
+    timer.mark('БД')
 
-    # Регистрация обработчиков
-    register_handlers(dp)
+    dp = create_dispatcher()
+    timer.mark('диспетчер')
+
+    if BOT_MODE == 'cluster':
+        # Воркеры создают свои диспетчеры и загружают цены сами
+        await run_cluster(
+            bot, create_dispatcher, dp.resolve_used_update_types(),
+            WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+            WORKERS, WORKER_BASE_PORT, WEBHOOK_SECRET)
+        return
+
+    # Загружаем цены в память один раз до начала обработки обновлений
+    await reload_cost_coefficients()
+    timer.mark('цены')
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    async def report_startup():
+        timer.mark('старт диспетчера')
+        print(timer.report())
+
+    dp.startup.register(report_startup)
+    # В режиме cluster метрики отдает каждый воркер на своем порту
+    dp.startup.register(metrics_server.start)
+    dp.shutdown.register(metrics_server.stop)
+
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(
+                dp, bot, WEBHOOK_URL, WEBHOOK_PATH,
+                WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        shutdown_render_pool()
 
 
 if __name__ == '__main__':
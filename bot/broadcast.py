@@ -1,62 +1,278 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
 from aiogram import Bot
-from aiogram.types import InputMediaPhoto, FSInputFile
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from models import UserData
-import os
-
-
-async def send_broadcast(bot: Bot):
-    # Получаем абсолютный путь к директории с изображениями
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    images_dir = os.path.join(base_dir, 'images')
-
-    image_paths = [
-        os.path.join(images_dir, 'march12.jpg')
-    ]
-
-    # Создаем сессию для работы с базой данных
-    engine = create_engine('sqlite:///user_data.db')
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    # Получаем всех пользователей из базы данных
-    users = session.query(UserData).all()
-
-    message_text = (
-        "Здравствуйте!\n\n"
-        "Вчера наш бот подвергся атаке. Злоумышленники получили доступ к отправке сообщений и рассылали материалы неподобающего характера. "
-        "Нам искренне жаль, что вам пришлось столкнуться с неудобствами.\n\n"
-        "Киберпреступления сегодня — глобальная проблема. Пожалуйста, будьте внимательны и не переходите по подозрительным ссылкам.\n\n"
-        "Сейчас все под контролем. Мы усилили меры безопасности и восстановили нормальную работу. "
-        "А также сделали <a href='https://t.me/hrl_calcbot'>нового бота</a> для вашего удобства.\n\n"
-        "Благодарим за понимание."
-    )
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError
+)
+from sqlalchemy import select, exists, func
+from sqlalchemy.dialects.sqlite import insert
+from database import Session, run_db
+from metrics import BROADCAST_MESSAGES
+from models import UserLatest, Broadcast, BroadcastRecipient
+
+# Общий лимит Telegram - около 30 сообщений в секунду на бота,
+# оставляем запас
+GLOBAL_RATE_LIMIT = 25
+# Не чаще одного сообщения в секунду в один чат. В рамках рассылки
+# пользователю уходит одно сообщение, поэтому лимит сдерживает
+# повторные попытки отправки в тот же чат
+PER_CHAT_INTERVAL = 1.0
+# Пауза перед повтором после сетевой ошибки или ошибки 5xx Telegram,
+# растет с каждой попыткой
+NETWORK_RETRY_DELAY = 1.0
+# Сколько сообщений может отправляться одновременно
+BROADCAST_CONCURRENCY = 10
+# Сколько получателей читается из БД и фиксируется за раз
+CHUNK_SIZE = 100
+# Как часто (в числе получателей) сохраняется прогресс
+RECORD_BATCH_SIZE = 20
+# Повторные попытки при сетевых ошибках, ошибках 5xx и RetryAfter
+MAX_ATTEMPTS = 3
+
+message_text = (
+    "Здравствуйте!\n\n"
+    "Вчера наш бот подвергся атаке. Злоумышленники получили доступ к отправке сообщений и рассылали материалы неподобающего характера. "
+    "Нам искренне жаль, что вам пришлось столкнуться с неудобствами.\n\n"
+    "Киберпреступления сегодня — глобальная проблема. Пожалуйста, будьте внимательны и не переходите по подозрительным ссылкам.\n\n"
+    "Сейчас все под контролем. Мы усилили меры безопасности и восстановили нормальную работу. "
+    "А также сделали <a href='https://t.me/hrl_calcbot'>нового бота</a> для вашего удобства.\n\n"
+    "Благодарим за понимание."
+)
+
+_task = None
+
+
+class RateLimiter:
+    """
+    Равномерно распределяет отправки: не более rate сообщений в секунду.
+    pause() останавливает все отправки, например после RetryAfter.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_at > now:
+                await asyncio.sleep(self._next_at - now)
+                now = time.monotonic()
+            self._next_at = now + self.interval
+
+    def pause(self, seconds):
+        self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+def _get_or_create_broadcast(text):
+    """
+    Возвращает незавершенную рассылку для продолжения или создает новую.
+    """
+    with Session() as session:
+        broadcast = session.query(Broadcast).filter(
+            Broadcast.finished_at.is_(None)).order_by(
+            Broadcast.id.desc()).first()
+        if broadcast is None:
+            broadcast = Broadcast(text=text)
+            session.add(broadcast)
+            session.commit()
+        return broadcast.id, broadcast.text
+
+
+def _next_recipients(broadcast_id, after_user_id, limit):
+    """
+    Следующая пачка уникальных user_id, которым рассылка еще не уходила
+    или не дошла из-за временной ошибки.
+    """
+    already_processed = exists().where(
+        BroadcastRecipient.broadcast_id == broadcast_id,
+        BroadcastRecipient.user_id == UserLatest.user_id,
+        BroadcastRecipient.status != 'retry')
+    # В user_latest ровно одна строка на пользователя
+    query = select(UserLatest.user_id).where(
+        UserLatest.user_id > after_user_id,
+        ~already_processed
+    ).order_by(UserLatest.user_id).limit(limit)
+    with Session() as session:
+        return session.scalars(query).all()
+
+
+def _record_results(broadcast_id, results):
+    if not results:
+        return
+    statement = insert(BroadcastRecipient).values([
+        {
+            'broadcast_id': broadcast_id,
+            'user_id': user_id,
+            'status': status,
+            'error': error,
+        }
+        for user_id, status, error in results
+    ])
+    # Повторная попытка заменяет прежний статус retry
+    statement = statement.on_conflict_do_update(
+        index_elements=['broadcast_id', 'user_id'],
+        set_={'status': statement.excluded.status,
+              'error': statement.excluded.error})
+    with Session() as session:
+        session.execute(statement)
+        session.commit()
 
-    # Формируем медиагруппу
-    # media = [InputMediaPhoto(
-    #     media=FSInputFile(image_path)) for image_path in image_paths]
-    # media[0].caption = message_text
-    # media[0].parse_mode = 'HTML'
 
-    # Отправляем сообщения каждому пользователю
-    # for user in users:
-    #     try:
-    #         await bot.send_media_group(chat_id=user.user_id, media=media)
-    #     except Exception as e:
-    #         print(f"Ошибка при отправке сообщения пользователю {user.user_id}: {e}")
+def _finish_broadcast(broadcast_id):
+    """
+    Завершает рассылку, если не осталось получателей со статусом retry;
+    иначе она останется незавершенной и продолжится при следующем запуске.
+    """
+    with Session() as session:
+        counts = dict(session.execute(
+            select(BroadcastRecipient.status, func.count()).where(
+                BroadcastRecipient.broadcast_id == broadcast_id
+            ).group_by(BroadcastRecipient.status)).all())
+        if not counts.get('retry'):
+            session.query(Broadcast).filter_by(id=broadcast_id).update(
+                {'finished_at': datetime.now()})
+            session.commit()
+        return counts
 
-    # session.close()
 
-    # Отправляем текстовые сообщения каждому пользователю
-    for user in users:
+async def _send_one(bot: Bot, limiter, user_id, text):
+    """
+    Отправляет сообщение одному пользователю.
+
+    :return: (user_id, статус sent, failed или retry, текст ошибки)
+    """
+    error = None
+    last_attempt_at = None
+    for attempt in range(MAX_ATTEMPTS):
+        if last_attempt_at is not None:
+            delay = last_attempt_at + PER_CHAT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await limiter.acquire()
+        last_attempt_at = time.monotonic()
         try:
             await bot.send_message(
-                chat_id=user.user_id,
-                text=message_text,
-                parse_mode='HTML'
-            )
+                chat_id=user_id, text=text, parse_mode='HTML')
+            return user_id, 'sent', None
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - притормаживаем всю рассылку
+            limiter.pause(e.retry_after)
+            error = str(e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            # Сбой сети или временная ошибка на стороне Telegram
+            await asyncio.sleep(NETWORK_RETRY_DELAY * (attempt + 1))
+            error = str(e)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или чат не существует -
+            # единственные ошибки, после которых получатель не повторяется
+            return user_id, 'failed', str(e)
         except Exception as e:
-            print(f"Ошибка при отправке сообщения пользователю {user.user_id}: {e}")
+            # Непредвиденная ошибка не считается окончательной:
+            # получатель будет повторен при продолжении рассылки
+            logging.exception(
+                f"Непредвиденная ошибка при отправке сообщения "
+                f"пользователю {user_id}")
+            return user_id, 'retry', str(e) or type(e).__name__
+    # Ошибка временная: получатель будет повторен при продолжении рассылки
+    return user_id, 'retry', error
+
+
+async def run_broadcast(bot: Bot, report_chat_id=None):
+    """
+    Рассылает сообщение всем уникальным пользователям.
+    Получатели читаются из БД пачками, результат по каждому сохраняется,
+    поэтому прерванная рассылка при следующем запуске продолжится с места
+    остановки.
+    """
+    broadcast_id, text = await run_db(_get_or_create_broadcast, message_text)
+    limiter = RateLimiter(GLOBAL_RATE_LIMIT)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    sent = 0
+
+    async def send(user_id):
+        async with semaphore:
+            return await _send_one(bot, limiter, user_id, text)
+
+    last_user_id = -1
+    while True:
+        user_ids = await run_db(
+            _next_recipients, broadcast_id, last_user_id, CHUNK_SIZE)
+        if not user_ids:
+            break
+        tasks = [asyncio.create_task(send(uid)) for uid in user_ids]
+        results = []
+        handled = set()
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                user_id, status, error = await next_result
+                handled.add(user_id)
+                results.append((user_id, status, error))
+                BROADCAST_MESSAGES.inc(status=status)
+                if status == 'sent':
+                    sent += 1
+                else:
+                    logging.warning(
+                        f"Ошибка при отправке сообщения пользователю "
+                        f"{user_id}: {error}")
+                if len(results) >= RECORD_BATCH_SIZE:
+                    await run_db(_record_results, broadcast_id, results)
+                    results = []
+        finally:
+            # При остановке сохраняем уже отправленное, в том числе
+            # завершенные отправки, до которых не дошел цикл выше, чтобы
+            # при продолжении не отправить их повторно
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    result = task.result()
+                    if result[0] not in handled:
+                        results.append(result)
+            await run_db(_record_results, broadcast_id, results)
+        last_user_id = user_ids[-1]
+
+    counts = await run_db(_finish_broadcast, broadcast_id)
+    elapsed = time.monotonic() - started
+    retry = counts.get('retry', 0)
+    report = (
+        f"Рассылка #{broadcast_id} "
+        f"{'приостановлена' if retry else 'завершена'}.\n"
+        f"Отправлено: {counts.get('sent', 0)}, "
+        f"ошибок: {counts.get('failed', 0)}.\n"
+    )
+    if retry:
+        report += (
+            f"Не доставлено из-за временных ошибок: {retry}, они будут "
+            f"повторены при следующем /broadcast.\n")
+    report += (
+        f"В этом запуске: {sent} сообщений за {elapsed:.1f} с "
+        f"({sent / elapsed if elapsed else 0:.1f} сообщ./с)"
+    )
+    logging.info(report)
+    if report_chat_id is not None:
+        await bot.send_message(chat_id=report_chat_id, text=report)
+    return counts
+
+
+def start_broadcast(bot: Bot, report_chat_id=None):
+    """
+    Запускает рассылку в фоне, не блокируя обработчик команды.
+
+    :return: False, если рассылка уже идет
+    """
+    global _task
+    if _task is not None and not _task.done():
+        return False
+    _task = asyncio.create_task(run_broadcast(bot, report_chat_id))
+    _task.add_done_callback(_log_task_error)
+    return True
+
 
-    session.close()
+def _log_task_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Рассылка прервана с ошибкой: {task.exception()}")
@@ -1,12 +1,66 @@
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from models import PaperCosts, TypicalOperations
 import logging
+from metrics import CALCULATION_SECONDS, timed
 
-engine = create_engine('sqlite:///user_data.db')
-Session = sessionmaker(bind=engine)
 
+class CalculationResult:
+    """
+    Итоги расчета по одной анкете. Считаются один раз после ввода всех
+    данных и затем используются для выводов, графика и заявки.
+    """
+    __slots__ = (
+        'total_paper_costs', 'total_logistics_costs',
+        'total_operations_costs', 'total_license_costs',
+    )
 
+    def __init__(self, total_paper_costs, total_logistics_costs,
+                 total_operations_costs, total_license_costs):
+        self.total_paper_costs = total_paper_costs
+        self.total_logistics_costs = total_logistics_costs
+        self.total_operations_costs = total_operations_costs
+        self.total_license_costs = total_license_costs
+
+    @property
+    def current_costs(self):
+        """
+        Расходы на бумажное КДП.
+        """
+        return (self.total_paper_costs + self.total_logistics_costs +
+                self.total_operations_costs)
+
+    @property
+    def savings(self):
+        return self.current_costs - self.total_license_costs
+
+    def as_tuple(self):
+        """
+        Итоги в порядке аргументов generate_cost_graph.
+        """
+        return (self.total_paper_costs, self.total_logistics_costs,
+                self.total_operations_costs, self.total_license_costs)
+
+    def as_dict(self):
+        """
+        Словарь с именами колонок UserData, пригодный для хранения в FSM.
+        """
+        return dict(zip(self.__slots__, self.as_tuple()))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{name: values[name] for name in cls.__slots__})
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :return: Результат из записи UserData или None, если итоги
+            в записи не сохранены
+        """
+        values = [getattr(row, name) for name in cls.__slots__]
+        if any(value is None for value in values):
+            return None
+        return cls(*values)
+
+
+@timed(CALCULATION_SECONDS, step='documents_per_year')
 def calculate_documents_per_year(data):
     employee_count = data['employee_count']
     documents_per_employee = data['documents_per_employee']
@@ -18,18 +72,18 @@ def calculate_documents_per_year(data):
     return result
 
 
-def calculate_pages_per_year(data):
-    documents_per_year = calculate_documents_per_year(data)
+@timed(CALCULATION_SECONDS, step='pages_per_year')
+def calculate_pages_per_year(data, documents_per_year=None):
+    if documents_per_year is None:
+        documents_per_year = calculate_documents_per_year(data)
     pages_per_document = data['pages_per_document']
     result = documents_per_year * pages_per_document
     logging.debug(f"Calculated pages per year: {result}")
     return result
 
 
-def calculate_total_paper_costs(pages_per_year):
-    session = Session()
-    paper_costs = session.query(PaperCosts).first()
-    session.close()
+@timed(CALCULATION_SECONDS, step='total_paper_costs')
+def calculate_total_paper_costs(pages_per_year, paper_costs):
     result = pages_per_year * (
         paper_costs.page_cost + paper_costs.printing_cost +
         paper_costs.storage_cost + paper_costs.rent_cost)
@@ -37,6 +91,7 @@ def calculate_total_paper_costs(pages_per_year):
     return result
 
 
+@timed(CALCULATION_SECONDS, step='total_logistics_costs')
 def calculate_total_logistics_costs(data, documents_per_year):
     courier_delivery_cost = data['courier_delivery_cost']
     hr_delivery_percentage = data.get('hr_delivery_percentage', 0)
@@ -46,6 +101,7 @@ def calculate_total_logistics_costs(data, documents_per_year):
     return total_logistics_costs
 
 
+@timed(CALCULATION_SECONDS, step='cost_per_minute')
 def calculate_cost_per_minute(data):
     average_salary = data['average_salary']
     working_minutes_per_month = data.get('working_minutes_per_month', 10080)
@@ -55,11 +111,9 @@ def calculate_cost_per_minute(data):
     return average_salary / working_minutes_per_month
 
 
+@timed(CALCULATION_SECONDS, step='total_operations_costs')
 def calculate_total_operations_costs(
-        data, documents_per_year, cost_per_minute):
-    session = Session()
-    typical_operations = session.query(TypicalOperations).first()
-    session.close()
+        data, documents_per_year, cost_per_minute, typical_operations):
     time_of_printing = typical_operations.time_of_printing
     time_of_signing = typical_operations.time_of_signing
     time_of_archiving = typical_operations.tome_of_archiving
@@ -72,6 +126,7 @@ def calculate_total_operations_costs(
     return total_operations_costs
 
 
+@timed(CALCULATION_SECONDS, step='total_license_costs')
 def calculate_total_license_costs(data, license_costs):
     hr_specialist_count = data['hr_specialist_count']
     employee_count = data['employee_count']
@@ -93,3 +148,25 @@ def calculate_total_license_costs(data, license_costs):
     )
     logging.debug(f"Calculated total license costs: {total_license_costs}")
     return total_license_costs
+
+
+def calculate_costs(data, coefficients):
+    """
+    Полный расчет по ответам анкеты и снимку цен.
+
+    :return: CalculationResult
+    """
+    documents_per_year = calculate_documents_per_year(data)
+    pages_per_year = calculate_pages_per_year(data, documents_per_year)
+    cost_per_minute = calculate_cost_per_minute(data)
+    return CalculationResult(
+        total_paper_costs=calculate_total_paper_costs(
+            pages_per_year, coefficients.paper),
+        total_logistics_costs=calculate_total_logistics_costs(
+            data, documents_per_year),
+        total_operations_costs=calculate_total_operations_costs(
+            data, documents_per_year, cost_per_minute,
+            coefficients.operations),
+        total_license_costs=calculate_total_license_costs(
+            data, coefficients.license),
+    )
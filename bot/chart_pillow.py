@@ -0,0 +1,169 @@
+"""
+Быстрая отрисовка графика сравнения расходов на Pillow.
+
+Неизменные элементы (заголовок, подписи осей и категорий, рамка)
+растрируются один раз на процесс, а для каждого графика поверх копии
+фона рисуются только шкала, сетка и столбцы.
+"""
+import importlib.util
+import io
+import math
+import os
+from functools import lru_cache
+from decouple import Config, RepositoryEnv
+from PIL import Image, ImageDraw, ImageFont
+
+config = Config(RepositoryEnv('.env'))
+# Путь к TTF-шрифту с кириллицей; по умолчанию DejaVu Sans из matplotlib
+CHART_FONT = config('CHART_FONT', default='')
+
+WIDTH, HEIGHT = 800, 480
+# Границы области построения: слева, сверху, справа, снизу
+PLOT_BOX = (110, 60, 770, 400)
+BAR_WIDTH = 0.4  # Доля ширины категории
+Y_TICKS = 5
+# Число цветов в палитре PNG (сглаженный текст дает оттенки серого)
+PALETTE_SIZE = 64
+
+TITLE = 'Сравнение текущих расходов на КДП и КЭДО от HRlink'
+X_LABEL = 'Категории расходов'
+Y_LABEL = 'Стоимость (руб.)'
+CATEGORIES = ('Текущий КДП', 'КЭДО от HRlink')
+COLORS = ((0, 128, 0), (0, 0, 255))  # green и blue, как в matplotlib
+TEXT_COLOR = (0, 0, 0)
+GRID_COLOR = (176, 176, 176)
+BACKGROUND = (255, 255, 255)
+
+
+def _default_font_path():
+    """
+    DejaVu Sans из поставки matplotlib: находим файл, не импортируя
+    сам matplotlib.
+    """
+    spec = importlib.util.find_spec('matplotlib')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    path = os.path.join(
+        spec.submodule_search_locations[0],
+        'mpl-data', 'fonts', 'ttf', 'DejaVuSans.ttf')
+    return path if os.path.exists(path) else None
+
+
+@lru_cache(maxsize=None)
+def _font(size):
+    path = CHART_FONT or _default_font_path()
+    if path:
+        return ImageFont.truetype(path, size)
+    # Встроенный шрифт Pillow без кириллицы - только на крайний случай
+    return ImageFont.load_default(size)
+
+
+def _text_center(draw, center_x, top, text, font):
+    width = draw.textlength(text, font=font)
+    draw.text((center_x - width / 2, top), text, fill=TEXT_COLOR, font=font)
+
+
+def _category_centers():
+    left, _, right, _ = PLOT_BOX
+    slot = (right - left) / len(CATEGORIES)
+    return [left + slot * (index + 0.5) for index in range(len(CATEGORIES))]
+
+
+@lru_cache(maxsize=1)
+def _background():
+    """
+    Статичная часть графика, общая для всех значений.
+    """
+    image = Image.new('RGB', (WIDTH, HEIGHT), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = PLOT_BOX
+
+    _text_center(draw, WIDTH / 2, 20, TITLE, _font(17))
+    for center, category in zip(_category_centers(), CATEGORIES):
+        _text_center(draw, center, bottom + 8, category, _font(13))
+    _text_center(draw, (left + right) / 2, bottom + 40, X_LABEL, _font(14))
+
+    # Подпись оси Y рисуется горизонтально и поворачивается
+    font = _font(14)
+    width = int(draw.textlength(Y_LABEL, font=font)) + 2
+    label = Image.new('RGB', (width, 20), BACKGROUND)
+    ImageDraw.Draw(label).text((0, 0), Y_LABEL, fill=TEXT_COLOR, font=font)
+    label = label.rotate(90, expand=True)
+    image.paste(label, (12, int((top + bottom - label.height) / 2)))
+    return image
+
+
+def _nice_step(maximum):
+    """
+    Шаг шкалы из ряда 1, 2, 2.5, 5 x 10^n, дающий не больше Y_TICKS
+    делений до maximum.
+    """
+    if maximum <= 0:
+        return 1
+    raw = maximum / Y_TICKS
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for multiplier in (1, 2, 2.5, 5, 10):
+        if raw <= multiplier * magnitude:
+            return multiplier * magnitude
+    return 10 * magnitude
+
+
+def _format(value):
+    return f'{value:,.0f}'.replace(',', ' ')
+
+
+def _draw(current_kdp_costs, kedo_costs):
+    image = _background().copy()
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = PLOT_BOX
+    values = (current_kdp_costs, kedo_costs)
+
+    step = _nice_step(max(max(values), 0))
+    # Запас сверху под подписи значений над столбцами
+    ticks = math.ceil(max(max(values), 0) * 1.08 / step) or 1
+    scale_max = ticks * step
+
+    def y(value):
+        return bottom - (bottom - top) * max(value, 0) / scale_max
+
+    tick_font = _font(12)
+    for index in range(ticks + 1):
+        value = step * index
+        position = y(value)
+        draw.line((left, position, right, position), fill=GRID_COLOR)
+        label = _format(value)
+        width = draw.textlength(label, font=tick_font)
+        draw.text(
+            (left - 8 - width, position - 7), label, fill=TEXT_COLOR,
+            font=tick_font)
+
+    slot = (right - left) / len(CATEGORIES)
+    value_font = _font(13)
+    for center, value, color in zip(_category_centers(), values, COLORS):
+        half = slot * BAR_WIDTH / 2
+        draw.rectangle(
+            (center - half, y(value), center + half, bottom), fill=color)
+        _text_center(draw, center, y(value) - 20, _format(value), value_font)
+    draw.rectangle((left, top, right, bottom), outline=TEXT_COLOR)
+    return image
+
+
+@lru_cache(maxsize=1)
+def _palette():
+    """
+    Палитра PNG, подобранная один раз по пробному графику: цвета у всех
+    графиков одинаковые, меняются только размеры столбцов.
+    """
+    return _draw(1_234_567, 345_678).quantize(colors=PALETTE_SIZE)
+
+
+def render_cost_graph(current_kdp_costs, kedo_costs):
+    """
+    Рисует тот же график, что и graph.render_cost_graph, и возвращает
+    байты PNG с палитрой.
+    """
+    image = _draw(current_kdp_costs, kedo_costs).quantize(
+        palette=_palette(), dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
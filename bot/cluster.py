@@ -0,0 +1,221 @@
+"""
+Многопроцессный режим: прием вебхука в главном процессе и обработка
+обновлений в нескольких процессах-воркерах.
+
+Обновления одного пользователя всегда попадают в один и тот же воркер
+(user_id % WORKERS), поэтому кэши состояний FSM в воркерах не
+конфликтуют, а общее состояние хранится в SQLite. Обновления
+администраторов направляются в воркер 0, поэтому /broadcast, /users и
+другие админские задачи выполняются только в нем.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import secrets
+import signal
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from coefficients import reload_cost_coefficients
+from filters import ADMIN_IDS
+from graph import shutdown_render_pool
+from metrics import add_metrics_routes, instrument_bot
+from webhook import (
+    RecentUpdates, WebhookHandler, SECRET_HEADER, serve_app
+)
+
+# Сколько раз пытаться передать обновление воркеру (например, пока он
+# еще запускается)
+FORWARD_ATTEMPTS = 5
+# Сколько секунд ждать запуска воркеров перед регистрацией вебхука
+WORKER_STARTUP_TIMEOUT = 60
+WORKER_PATH = '/update'
+
+
+def get_update_user_id(payload):
+    """
+    Достает ID пользователя из сырого JSON обновления.
+    """
+    for value in payload.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if user:
+                return user['id']
+            chat = value.get('chat')
+            if chat:
+                return chat['id']
+    return 0
+
+
+def pick_worker(user_id, workers):
+    """
+    Номер воркера для пользователя: администраторы - всегда воркер 0.
+    """
+    if user_id in ADMIN_IDS:
+        return 0
+    return user_id % workers
+
+
+class UpdateRouter:
+    """
+    Принимает вебхук Telegram и пересылает обновление воркеру,
+    отвечая Telegram сразу, не дожидаясь обработки.
+    """
+    def __init__(self, worker_urls, secret_token, internal_secret):
+        self.worker_urls = worker_urls
+        self.secret_token = secret_token
+        self.internal_secret = internal_secret
+        self.recent = RecentUpdates()
+        self.session = None
+        self._tasks = set()
+
+    async def handle(self, request: web.Request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not secrets.compare_digest(token, self.secret_token):
+            return web.Response(status=401)
+
+        body = await request.read()
+        payload = json.loads(body)
+        if self.recent.add(payload.get('update_id')):
+            worker = pick_worker(
+                get_update_user_id(payload), len(self.worker_urls))
+            task = asyncio.create_task(
+                self.forward(self.worker_urls[worker], body))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def forward(self, url, body):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={
+                    SECRET_HEADER: self.internal_secret,
+                    'Content-Type': 'application/json',
+                })
+        for attempt in range(FORWARD_ATTEMPTS):
+            try:
+                async with self.session.post(url, data=body) as response:
+                    if response.status == 200:
+                        return
+                    logging.error(
+                        f"Воркер {url} ответил {response.status}")
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2 * 2 ** attempt)
+        logging.error(f"Не удалось передать обновление воркеру {url}")
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+
+async def wait_for_workers(worker_urls, timeout=WORKER_STARTUP_TIMEOUT):
+    """
+    Ждет, пока все воркеры начнут принимать соединения.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        for url in worker_urls:
+            while True:
+                try:
+                    # Любой HTTP-ответ означает, что сервер воркера запущен
+                    async with session.get(url):
+                        break
+                except aiohttp.ClientConnectionError:
+                    if loop.time() > deadline:
+                        raise RuntimeError(f"Воркер {url} не запустился")
+                    await asyncio.sleep(0.2)
+
+
+async def _worker_main(
+        index, token, create_dispatcher, port, internal_secret):
+    # terminate() из главного процесса завершает воркер штатно,
+    # с сохранением состояний FSM
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+    bot = instrument_bot(Bot(token=token))
+    dp = create_dispatcher(primary=index == 0)
+    await reload_cost_coefficients()
+
+    handler = WebhookHandler(dp, bot, internal_secret)
+    app = web.Application()
+    app.router.add_post(WORKER_PATH, handler.handle)
+    # Сервер воркера слушает только 127.0.0.1, поэтому метрики
+    # отдаются на том же порту
+    add_metrics_routes(app)
+
+    await dp.emit_startup(bot=bot)
+    try:
+        await serve_app(app, '127.0.0.1', port)
+    finally:
+        await handler.wait_closed()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        shutdown_render_pool()
+
+
+def run_worker(index, token, create_dispatcher, port, internal_secret):
+    """
+    Точка входа процесса-воркера.
+    """
+    logging.info(f"Воркер {index} слушает 127.0.0.1:{port}")
+    try:
+        asyncio.run(_worker_main(
+            index, token, create_dispatcher, port, internal_secret))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+async def run_cluster(
+        bot: Bot, create_dispatcher, allowed_updates, url, path, host, port,
+        workers, worker_base_port, secret_token=None):
+    """
+    Запускает воркеры и принимающий вебхук сервер.
+
+    :param create_dispatcher: Функция уровня модуля, создающая Dispatcher
+        с зарегистрированными обработчиками. Вызывается в каждом воркере,
+        primary=True передается только воркеру 0
+    """
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    internal_secret = secrets.token_urlsafe(32)
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(index, bot.token, create_dispatcher,
+                  worker_base_port + index, internal_secret),
+            name=f'bot-worker-{index}')
+        process.start()
+        processes.append(process)
+
+    worker_urls = [
+        f'http://127.0.0.1:{worker_base_port + index}{WORKER_PATH}'
+        for index in range(workers)
+    ]
+    router = UpdateRouter(worker_urls, secret_token, internal_secret)
+    app = web.Application()
+    app.router.add_post(path, router.handle)
+
+    try:
+        await wait_for_workers(worker_urls)
+        await bot.set_webhook(
+            url=url.rstrip('/') + path,
+            secret_token=secret_token,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=True)
+        logging.info(
+            f"Вебхук слушает {host}:{port}{path}, воркеров: {workers}")
+        await serve_app(app, host, port)
+    finally:
+        await router.close()
+        await bot.session.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, replace
+from database import Session, run_db
+from models import PaperCosts, LicenseCosts, TypicalOperations
+
+# Через сколько секунд снимок коэффициентов перечитывается из БД.
+# Цены хранятся в общей БД, поэтому так же быстро новые цены после
+# /reload_prices подхватывают и остальные воркеры многопроцессного режима
+COEFFICIENTS_TTL = 30
+
+
+@dataclass(frozen=True)
+class PaperCostsSnapshot:
+    page_cost: float
+    printing_cost: float
+    storage_cost: float
+    rent_cost: float
+
+
+@dataclass(frozen=True)
+class LicenseCostsSnapshot:
+    main_license_cost: float
+    hr_license_cost: float
+    employee_license_cost: float
+
+
+@dataclass(frozen=True)
+class TypicalOperationsSnapshot:
+    time_of_printing: int
+    time_of_signing: int
+    tome_of_archiving: int
+
+
+@dataclass(frozen=True)
+class CostCoefficients:
+    """
+    Неизменяемый снимок таблиц с ценами, которые используются в расчетах.
+    Атрибуты вложенных снимков совпадают с полями моделей, поэтому
+    функции из calculations.py принимают их вместо строк БД.
+    """
+    paper: PaperCostsSnapshot
+    license: LicenseCostsSnapshot
+    operations: TypicalOperationsSnapshot
+    version: int = 0
+    loaded_at: float = 0.0
+
+
+_snapshot = None
+_reload_lock = asyncio.Lock()
+_refresh_lock = asyncio.Lock()
+
+
+def load_cost_coefficients():
+    """
+    Синхронно читает цены из БД в новый снимок (версия не назначается).
+    """
+    with Session() as session:
+        paper = session.query(PaperCosts).first()
+        license_costs = session.query(LicenseCosts).first()
+        operations = session.query(TypicalOperations).first()
+        return CostCoefficients(
+            paper=PaperCostsSnapshot(
+                page_cost=paper.page_cost,
+                printing_cost=paper.printing_cost,
+                storage_cost=paper.storage_cost,
+                rent_cost=paper.rent_cost),
+            license=LicenseCostsSnapshot(
+                main_license_cost=license_costs.main_license_cost,
+                hr_license_cost=license_costs.hr_license_cost,
+                employee_license_cost=license_costs.employee_license_cost),
+            operations=TypicalOperationsSnapshot(
+                time_of_printing=operations.time_of_printing,
+                time_of_signing=operations.time_of_signing,
+                tome_of_archiving=operations.tome_of_archiving),
+        )
+
+
+async def reload_cost_coefficients():
+    """
+    Перечитывает цены из БД и атомарно заменяет снимок.
+    Версия увеличивается только если значения действительно изменились.
+    """
+    global _snapshot
+    async with _reload_lock:
+        fresh = await run_db(load_cost_coefficients)
+        current = _snapshot
+        if current is None:
+            version = 1
+        elif (fresh.paper, fresh.license, fresh.operations) == (
+                current.paper, current.license, current.operations):
+            version = current.version
+        else:
+            version = current.version + 1
+            logging.info(f"Коэффициенты расчета обновлены, версия {version}")
+        _snapshot = replace(
+            fresh, version=version, loaded_at=time.monotonic())
+        return _snapshot
+
+
+def _is_fresh(snapshot):
+    return (snapshot is not None and
+            time.monotonic() - snapshot.loaded_at <= COEFFICIENTS_TTL)
+
+
+async def get_cost_coefficients():
+    """
+    Возвращает текущий снимок цен, обычно без обращения к БД.
+    Снимок старше COEFFICIENTS_TTL перечитывается перед расчетом, чтобы
+    ни один расчет не шел по ценам старше этого срока; одновременные
+    запросы ждут одного перечитывания.
+    """
+    snapshot = _snapshot
+    if _is_fresh(snapshot):
+        return snapshot
+    async with _refresh_lock:
+        # Пока ждали, снимок мог обновить другой запрос
+        if _is_fresh(_snapshot):
+            return _snapshot
+        try:
+            return await reload_cost_coefficients()
+        except Exception as e:
+            if _snapshot is None:
+                raise
+            logging.error(f"Ошибка при обновлении коэффициентов: {e}")
+            return _snapshot
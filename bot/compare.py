@@ -0,0 +1,114 @@
+"""
+Сравнение тарифов по сохраненным ответам анкеты.
+
+Все тарифы и варианты численности и текучести считаются одним
+векторизованным проходом compute_batch по сетке сценариев.
+"""
+import numpy as np
+from batch import INPUT_COLUMNS, compute_batch
+
+# Тарифы: (license_type, название, с какой и до какой численности
+# сотрудников тариф предлагается в анкете)
+TARIFFS = (
+    ('lite', 'HRlink Lite', 0, 499),
+    ('standard', 'HRlink Standard', 0, 1999),
+    ('enterprise', 'HRlink Enterprise', 2000, None),
+)
+# Множители численности сотрудников для графика
+EMPLOYEE_FACTORS = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4)
+TURNOVER_VALUES = (0, 10, 20, 30, 50)
+
+
+class TariffComparison:
+    """
+    Результат сравнения тарифов для одной анкеты.
+
+    by_tariff: [(название, доступен ли, КДП, HRlink, экономия)]
+        при ответах пользователя
+    employee_counts, employee_savings: экономия по тарифам (в порядке
+        TARIFFS) для вариантов численности при текучести пользователя
+    turnover_savings: экономия по тарифам для TURNOVER_VALUES при
+        численности пользователя
+    """
+    __slots__ = (
+        'employee_count', 'turnover_percentage', 'by_tariff',
+        'employee_counts', 'employee_savings', 'turnover_savings',
+    )
+
+    def __init__(self, employee_count, turnover_percentage, by_tariff,
+                 employee_counts, employee_savings, turnover_savings):
+        self.employee_count = employee_count
+        self.turnover_percentage = turnover_percentage
+        self.by_tariff = by_tariff
+        self.employee_counts = employee_counts
+        self.employee_savings = employee_savings
+        self.turnover_savings = turnover_savings
+
+
+def is_available(tariff, employee_count):
+    _, _, minimum, maximum = tariff
+    return employee_count >= minimum and (
+        maximum is None or employee_count <= maximum)
+
+
+def compare_tariffs(entry, coefficients):
+    """
+    :param entry: Запись UserData с ответами анкеты
+    :param coefficients: Снимок цен CostCoefficients
+    :return: TariffComparison
+    """
+    employee_count = entry.employee_count
+    turnover = entry.turnover_percentage
+    employee_counts = sorted({
+        max(1, round(employee_count * factor))
+        for factor in EMPLOYEE_FACTORS
+    })
+
+    # Сетка сценариев: численность x текучесть x тариф. Первая часть -
+    # варианты численности при текучести пользователя, вторая - варианты
+    # текучести при его численности
+    counts = np.array(
+        employee_counts + [employee_count] * len(TURNOVER_VALUES),
+        dtype=float)
+    turnovers = np.array(
+        [turnover] * len(employee_counts) + list(TURNOVER_VALUES),
+        dtype=float)
+    scenarios = len(counts)
+    license_types = np.array([tariff[0] for tariff in TARIFFS], dtype=object)
+
+    columns = {}
+    for column in INPUT_COLUMNS:
+        if column.key in ('id', 'license_type'):
+            continue
+        value = getattr(entry, column.key)
+        columns[column.key] = np.full(
+            scenarios * len(TARIFFS), np.nan if value is None else value,
+            dtype=float)
+    columns['employee_count'] = np.repeat(counts, len(TARIFFS))
+    columns['turnover_percentage'] = np.repeat(turnovers, len(TARIFFS))
+    columns['license_type'] = np.tile(license_types, scenarios)
+
+    results = compute_batch(columns, coefficients)
+    current = (
+        results['total_paper_costs'] + results['total_logistics_costs'] +
+        results['total_operations_costs']).reshape(scenarios, len(TARIFFS))
+    license_costs = results['total_license_costs'].reshape(
+        scenarios, len(TARIFFS))
+    savings = current - license_costs
+
+    sweep = len(employee_counts)
+    own = employee_counts.index(employee_count)
+    by_tariff = [
+        (tariff[1], is_available(tariff, employee_count),
+         float(current[own, index]), float(license_costs[own, index]),
+         float(savings[own, index]))
+        for index, tariff in enumerate(TARIFFS)
+    ]
+    return TariffComparison(
+        employee_count=employee_count,
+        turnover_percentage=turnover,
+        by_tariff=by_tariff,
+        employee_counts=employee_counts,
+        employee_savings=savings[:sweep].T.tolist(),
+        turnover_savings=savings[sweep:].tolist(),
+    )
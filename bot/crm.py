@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import aiohttp
+from decouple import Config, RepositoryEnv
+from sqlalchemy import func
+from database import Session, run_db
+from metrics import CRM_LEADS, CRM_REQUEST_SECONDS, CRM_REQUEST_ERRORS
+from models import CrmOutbox
+
+config = Config(RepositoryEnv('.env'))
+# Адрес входящего вебхука Битрикс24, к нему добавляется имя метода
+BITRIX_WEBHOOK_URL = config(
+    'BITRIX_WEBHOOK_URL',
+    default='https://b24.hrlk.ru/rest/7414/d6bo0kujd1cm2owi/')
+
+# Битрикс24 принимает не более 50 команд в одном batch-запросе
+CRM_BATCH_SIZE = 50
+# Как часто проверять очередь, если новых лидов не поступало (в секундах)
+CRM_POLL_INTERVAL = 5
+# Повторные попытки: задержка растет вдвое, но не больше часа
+CRM_RETRY_BASE_DELAY = 10
+CRM_RETRY_MAX_DELAY = 60 * 60
+CRM_MAX_ATTEMPTS = 20
+CRM_REQUEST_TIMEOUT = 30
+# Источник лидов в Битрикс24: в ORIGIN_ID лида записывается id записи
+# очереди, по которому повторная отправка находит уже созданный лид
+CRM_ORIGINATOR_ID = 'hrlink_calc_bot'
+
+
+def build_query(params, prefix=None):
+    """
+    Раскладывает вложенные поля в пары ключ-значение в формате
+    fields[PHONE][0][VALUE], который ожидают команды batch.
+    """
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    pairs = []
+    for key, value in items:
+        name = f'{prefix}[{key}]' if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            pairs.extend(build_query(value, name))
+        else:
+            pairs.append((name, value))
+    return pairs
+
+
+def _enqueue(fields):
+    with Session() as session:
+        session.add(CrmOutbox(
+            payload=json.dumps(fields, ensure_ascii=False)))
+        session.commit()
+
+
+def _fetch_due(limit):
+    with Session() as session:
+        rows = session.query(CrmOutbox).filter(
+            CrmOutbox.status == 'pending',
+            CrmOutbox.next_attempt_at <= datetime.now()
+        ).order_by(CrmOutbox.id).limit(limit).all()
+        return [(row.id, json.loads(row.payload), row.attempts)
+                for row in rows]
+
+
+def _mark_results(sent, failed):
+    """
+    :param sent: {id записи: ID лида в Битрикс24}
+    :param failed: {id записи: (число попыток, текст ошибки)}
+    """
+    now = datetime.now()
+    with Session() as session:
+        for outbox_id, lead_id in sent.items():
+            session.query(CrmOutbox).filter_by(id=outbox_id).update({
+                'status': 'sent', 'sent_at': now, 'lead_id': lead_id,
+                'last_error': None,
+                'attempts': CrmOutbox.attempts + 1})
+        for outbox_id, (attempts, error) in failed.items():
+            delay = min(
+                CRM_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+                CRM_RETRY_MAX_DELAY)
+            session.query(CrmOutbox).filter_by(id=outbox_id).update({
+                'status': 'failed' if attempts >= CRM_MAX_ATTEMPTS
+                else 'pending',
+                'attempts': attempts,
+                'next_attempt_at': now + timedelta(seconds=delay),
+                'last_error': error})
+        session.commit()
+
+
+def _queue_depth():
+    with Session() as session:
+        return dict(session.query(
+            CrmOutbox.status, func.count()).filter(
+            CrmOutbox.status != 'sent').group_by(CrmOutbox.status).all())
+
+
+async def enqueue_lead(fields):
+    """
+    Сохраняет лид в очередь и будит фоновую отправку.
+    """
+    await run_db(_enqueue, fields)
+    CRM_LEADS.inc(result='enqueued')
+    crm_sender.wake()
+
+
+async def get_queue_depth():
+    """
+    :return: {'pending': ..., 'failed': ...}
+    """
+    counts = await run_db(_queue_depth)
+    return {
+        'pending': counts.get('pending', 0),
+        'failed': counts.get('failed', 0),
+    }
+
+
+class CrmSender:
+    """
+    Фоновая отправка лидов из очереди в Битрикс24 пачками через метод
+    batch с одной переиспользуемой HTTP-сессией.
+
+    Доставка "как минимум один раз": если ответ на batch потерян после
+    того, как Битрикс24 создал лиды, запись остается в очереди. Перед
+    повторной отправкой такие записи ищутся в Битрикс24 по ORIGIN_ID,
+    и найденные лиды не создаются заново.
+    """
+    def __init__(self, base_url=BITRIX_WEBHOOK_URL):
+        self.base_url = base_url.rstrip('/') + '/'
+        self._session = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    async def start(self):
+        if self._task is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=CRM_REQUEST_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=4))
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.send_due():
+                    pass
+            except Exception as e:
+                logging.error(f"Ошибка при отправке лидов в Битрикс24: {e}")
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=CRM_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _call(self, method, payload):
+        """
+        Вызывает метод REST API и возвращает поле result ответа.
+        """
+        started = time.perf_counter()
+        try:
+            async with self._session.post(
+                    self.base_url + method + '.json',
+                    json=payload) as response:
+                if response.status != 200:
+                    raise RuntimeError(
+                        f"HTTP {response.status}: {await response.text()}")
+                return (await response.json()).get('result', {})
+        except Exception:
+            CRM_REQUEST_ERRORS.inc(method=method)
+            raise
+        finally:
+            CRM_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, method=method)
+
+    async def _find_created(self, outbox_ids):
+        """
+        Ищет лиды, созданные прошлыми попытками, ответ на которые
+        не был получен.
+
+        :return: {id записи: ID лида в Битрикс24}
+        """
+        leads = await self._call('crm.lead.list', {
+            'filter': {
+                'ORIGINATOR_ID': CRM_ORIGINATOR_ID,
+                '@ORIGIN_ID': [str(outbox_id) for outbox_id in outbox_ids],
+            },
+            'select': ['ID', 'ORIGIN_ID'],
+        })
+        return {int(lead['ORIGIN_ID']): int(lead['ID']) for lead in leads}
+
+    async def send_due(self):
+        """
+        Отправляет одну пачку готовых к отправке лидов.
+
+        :return: число обработанных записей
+        """
+        rows = await run_db(_fetch_due, CRM_BATCH_SIZE)
+        if not rows:
+            return 0
+
+        sent, failed = {}, {}
+        retried = [outbox_id for outbox_id, _, attempts in rows if attempts]
+        if retried:
+            try:
+                sent = await self._find_created(retried)
+            except Exception as e:
+                # Не зная, созданы ли лиды, повторно их не отправляем
+                error = f"Проверка созданных лидов: {e or type(e).__name__}"
+                failed = {
+                    outbox_id: (attempts + 1, error)
+                    for outbox_id, _, attempts in rows if attempts
+                }
+        pending = [
+            row for row in rows if row[0] not in sent and row[0] not in failed
+        ]
+
+        commands = {
+            f'lead_{outbox_id}': 'crm.lead.add?' + urlencode(
+                build_query({'fields': {
+                    **fields,
+                    'ORIGINATOR_ID': CRM_ORIGINATOR_ID,
+                    'ORIGIN_ID': str(outbox_id),
+                }}))
+            for outbox_id, fields, attempts in pending
+        }
+        try:
+            result = await self._call(
+                'batch', {'halt': 0, 'cmd': commands}) if commands else {}
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            for outbox_id, fields, attempts in pending:
+                failed[outbox_id] = (attempts + 1, error)
+        else:
+            results = result.get('result') or {}
+            errors = result.get('result_error') or {}
+            for outbox_id, fields, attempts in pending:
+                name = f'lead_{outbox_id}'
+                if results.get(name):
+                    sent[outbox_id] = results[name]
+                else:
+                    error = errors.get(name) or 'Пустой ответ'
+                    if isinstance(error, dict):
+                        error = error.get('error_description') or str(error)
+                    failed[outbox_id] = (attempts + 1, str(error))
+
+        await run_db(_mark_results, sent, failed)
+        CRM_LEADS.inc(len(sent), result='sent')
+        CRM_LEADS.inc(len(failed), result='failed')
+        if sent:
+            logging.info(f"Лиды отправлены в Битрикс24: {len(sent)}")
+        for outbox_id, (attempts, error) in failed.items():
+            logging.error(
+                f"Ошибка при создании лида {outbox_id} "
+                f"(попытка {attempts}): {error}")
+        return len(rows)
+
+
+crm_sender = CrmSender()
@@ -0,0 +1,216 @@
+"""
+Локальная замена Битрикс24 для проверки отправки лидов из очереди.
+
+Сервер принимает методы batch (с командами crm.lead.add) и crm.lead.list
+и хранит лиды в памяти. Он умеет терять ответ на batch уже после
+создания лидов - как при обрыве связи или тайм-ауте на стороне бота.
+
+Сервер для ручной проверки, запуск из папки bot
+(в .env: BITRIX_WEBHOOK_URL=http://127.0.0.1:8099/):
+    python crm_standin.py serve --port 8099 --lose 1
+
+Самопроверка очереди лидов с потерянными ответами во временной БД:
+    python crm_standin.py check --leads 120 --lose 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+from aiohttp import web
+
+# Сколько лидов отдает crm.lead.list за один запрос, как в Битрикс24
+LIST_PAGE_SIZE = 50
+
+
+class BitrixStandIn:
+    """
+    Лиды в памяти и счетчики запросов.
+    """
+    def __init__(self, lose=0, latency=0.0):
+        # Сколько следующих ответов на batch потерять
+        self.lose = lose
+        self.latency = latency
+        self.leads = []
+        self.requests = {'batch': 0, 'crm.lead.list': 0, 'lost': 0}
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/batch.json', self.batch)
+        app.router.add_post('/crm.lead.list.json', self.lead_list)
+        return app
+
+    def _add_lead(self, query):
+        fields = {}
+        for key, value in parse_qsl(query):
+            # fields[NAME], fields[PHONE][0][VALUE] - храним только
+            # поля верхнего уровня
+            if key.startswith('fields[') and key.count('[') == 1:
+                fields[key[len('fields['):-1]] = value
+        fields['ID'] = len(self.leads) + 1
+        self.leads.append(fields)
+        return fields['ID']
+
+    async def batch(self, request):
+        self.requests['batch'] += 1
+        payload = await request.json()
+        results, errors = {}, {}
+        for name, command in payload.get('cmd', {}).items():
+            method, _, query = command.partition('?')
+            if method == 'crm.lead.add':
+                results[name] = self._add_lead(query)
+            else:
+                errors[name] = {
+                    'error': 'ERROR_METHOD_NOT_FOUND',
+                    'error_description': f'Метод {method} не поддерживается',
+                }
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.lose > 0:
+            # Лиды уже созданы, а ответ до клиента не доходит
+            self.lose -= 1
+            self.requests['lost'] += 1
+            request.transport.close()
+            return web.Response()
+        return web.json_response({'result': {
+            'result': results, 'result_error': errors,
+        }})
+
+    async def lead_list(self, request):
+        self.requests['crm.lead.list'] += 1
+        payload = await request.json()
+        conditions = payload.get('filter', {})
+        origin_ids = set(conditions.get('@ORIGIN_ID', []))
+        leads = [
+            lead for lead in self.leads
+            if lead.get('ORIGINATOR_ID') == conditions.get('ORIGINATOR_ID')
+            and lead.get('ORIGIN_ID') in origin_ids
+        ]
+        return web.json_response({
+            'result': [
+                {'ID': str(lead['ID']), 'ORIGIN_ID': lead['ORIGIN_ID']}
+                for lead in leads[:LIST_PAGE_SIZE]
+            ],
+            'total': len(leads),
+        })
+
+    def duplicates(self):
+        """
+        ORIGIN_ID, по которым создано больше одного лида.
+        """
+        seen, repeated = set(), set()
+        for lead in self.leads:
+            origin_id = lead.get('ORIGIN_ID')
+            if origin_id in seen:
+                repeated.add(origin_id)
+            seen.add(origin_id)
+        return sorted(repeated)
+
+
+async def start_server(stand_in, host, port):
+    """
+    :return: (runner, базовый URL вебхука)
+    """
+    runner = web.AppRunner(stand_in.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    # При port=0 порт выбирает система
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}/'
+
+
+async def serve(args):
+    stand_in = BitrixStandIn(lose=args.lose, latency=args.latency / 1000)
+    runner, url = await start_server(stand_in, args.host, args.port)
+    print(f"Замена Битрикс24 слушает {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(f"Лидов: {len(stand_in.leads)}, дублей: "
+              f"{len(stand_in.duplicates())}, запросы: {stand_in.requests}")
+        await runner.cleanup()
+
+
+async def check(args):
+    # Временная БД должна быть задана до импорта модулей бота
+    tmp_dir = tempfile.mkdtemp(prefix='crm-standin-')
+    os.environ['DATABASE_URL'] = (
+        f"sqlite:///{os.path.join(tmp_dir, 'crm.db')}")
+    import crm
+    from database import init_db, run_db
+
+    stand_in = BitrixStandIn(lose=args.lose, latency=args.latency / 1000)
+    runner, url = await start_server(stand_in, '127.0.0.1', 0)
+    # Повторы без пауз, чтобы проверка не ждала расписания очереди
+    crm.CRM_RETRY_BASE_DELAY = 0
+    crm.CRM_POLL_INTERVAL = 0.05
+    crm.CRM_REQUEST_TIMEOUT = args.timeout
+
+    init_db()
+    for index in range(args.leads):
+        await run_db(crm._enqueue, {
+            'TITLE': f'Проверка {index}', 'NAME': f'Лид {index}',
+            'PHONE': [{'VALUE': f'+7900{index:07d}', 'VALUE_TYPE': 'WORK'}],
+        })
+
+    sender = crm.CrmSender(url)
+    started = time.perf_counter()
+    await sender.start()
+    try:
+        while True:
+            depth = await crm.get_queue_depth()
+            if not depth['pending']:
+                break
+            if time.perf_counter() - started > args.deadline:
+                print(f"Очередь не разобрана за {args.deadline} с: {depth}")
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        await sender.stop()
+        await runner.cleanup()
+    elapsed = time.perf_counter() - started
+
+    duplicates = stand_in.duplicates()
+    print(f"Лидов в очереди: {args.leads}, создано в Битрикс24: "
+          f"{len(stand_in.leads)}, дублей: {len(duplicates)}")
+    print(f"Запросы: {stand_in.requests}, время: {elapsed:.2f} с")
+    print(f"Осталось в очереди: {depth}")
+    return not duplicates and not depth['pending'] and not depth['failed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'check'):
+        command = commands.add_parser(name)
+        command.add_argument(
+            '--lose', type=int, default=1,
+            help='Сколько ответов на batch потерять после создания лидов')
+        command.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Задержка ответа в миллисекундах')
+    commands.choices['serve'].add_argument('--host', default='127.0.0.1')
+    commands.choices['serve'].add_argument('--port', type=int, default=8099)
+    commands.choices['check'].add_argument('--leads', type=int, default=120)
+    commands.choices['check'].add_argument(
+        '--timeout', type=float, default=5.0,
+        help='Тайм-аут запроса к Битрикс24 в секундах')
+    commands.choices['check'].add_argument(
+        '--deadline', type=float, default=60.0,
+        help='Сколько секунд ждать разбора очереди')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+    elif not asyncio.run(check(args)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
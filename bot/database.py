@@ -1,12 +1,68 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Base, PaperCosts, LicenseCosts, TypicalOperations
+import asyncio
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import partial
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert
+from db_engine import engine, Session
+from metrics import DB_SECONDS
+from migrations import run_migrations
+from models import (
+    Base, UserData, UserLatest, PaperCosts, LicenseCosts, TypicalOperations,
+    DailyUsers
+)
+
+# Размер пула потоков для работы с БД
+DB_WORKERS = 4
+# Сколько ответов статистики по закрытым периодам хранить и как долго
+STATS_CACHE_SIZE = 256
+STATS_CACHE_TTL = 24 * 60 * 60
+
+# Синхронные запросы SQLAlchemy выполняются в отдельном ограниченном
+# пуле потоков, чтобы медленная запись или блокировка SQLite
+# не останавливала обработку обновлений остальных пользователей.
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_WORKERS, thread_name_prefix='db')
+
+# Обновление дневных наборов пользователей - это чтение и запись одной
+# строки, поэтому потоки пула выполняют его по очереди
+_daily_users_lock = threading.Lock()
+
+# (первый день, день после последнего) -> (число пользователей, время)
+_stats_cache = OrderedDict()
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию работы с БД в пуле db_executor.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(
+            db_executor, partial(func, *args, **kwargs))
+    finally:
+        # Время включает ожидание свободного потока пула
+        DB_SECONDS.observe(
+            time.perf_counter() - started, query=func.__name__)
+
+
+def ping():
+    """
+    Проверка доступности БД для /ready.
+    """
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
 
 
 def init_db():
-    engine = create_engine('sqlite:///user_data.db')
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    run_migrations(engine)
     session = Session()
 
     if not session.query(PaperCosts).first():
@@ -24,4 +80,165 @@ def init_db():
         session.add(typical_operations)
         session.commit()
 
+    # Заполняем дневные наборы пользователей по уже накопленным данным
+    if not session.query(DailyUsers).first():
+        _backfill_daily_users(session)
+
     session.close()
+
+
+def _backfill_daily_users(session):
+    days = {}
+    for user_id, timestamp in session.query(
+            UserData.user_id, UserData.timestamp):
+        if user_id is not None and timestamp is not None:
+            days.setdefault(timestamp.date(), set()).add(user_id)
+    for day, user_ids in days.items():
+        ids = array('q', sorted(user_ids))
+        session.add(DailyUsers(
+            day=day, user_ids=ids.tobytes(), users_count=len(ids)))
+    session.commit()
+
+
+def _add_daily_user(session, user_id, day):
+    """
+    Добавляет пользователя в набор уникальных пользователей за день.
+    """
+    row = session.get(DailyUsers, day)
+    ids = array('q')
+    if row is not None:
+        ids.frombytes(row.user_ids)
+    position = bisect_left(ids, user_id)
+    if position < len(ids) and ids[position] == user_id:
+        return
+    ids.insert(position, user_id)
+    if row is None:
+        session.add(DailyUsers(
+            day=day, user_ids=ids.tobytes(), users_count=len(ids)))
+    else:
+        row.user_ids = ids.tobytes()
+        row.users_count = len(ids)
+
+
+def _user_exists(user_id):
+    with Session() as session:
+        return session.get(UserLatest, user_id) is not None
+
+
+async def user_exists(user_id):
+    return await run_db(_user_exists, user_id)
+
+
+def _save_user_data(user_id, data, result):
+    now = datetime.now()
+    values = {
+        'organization_name': data.get('organization_name', 'Не указано'),
+        'employee_count': data.get('employee_count', None),
+        'hr_specialist_count': data.get('hr_specialist_count', None),
+        'license_type': data.get('license_type', 'standard'),
+        'tariff_name': data.get('tariff_name', 'HRlink Standard'),
+        'documents_per_employee': data.get('documents_per_employee', None),
+        'pages_per_document': data.get('pages_per_document', None),
+        'turnover_percentage': data.get('turnover_percentage', None),
+        'average_salary': data.get('average_salary', None),
+        'courier_delivery_cost': data.get('courier_delivery_cost', None),
+        'hr_delivery_percentage': data.get('hr_delivery_percentage', 0),
+        'timestamp': now,
+    }
+    # Результаты расчетов записываем вместе с анкетой
+    if result is not None:
+        values.update(result.as_dict())
+
+    with Session() as session:
+        # Каждый расчет добавляется в историю новой записью,
+        # а указатель на последнюю запись обновляется в той же транзакции
+        user_data_id = session.execute(insert(UserData).values(
+            user_id=user_id, **values)).inserted_primary_key[0]
+        session.execute(insert(UserLatest).values(
+            user_id=user_id, user_data_id=user_data_id
+        ).on_conflict_do_update(
+            index_elements=[UserLatest.user_id],
+            set_={'user_data_id': user_data_id}))
+        with _daily_users_lock:
+            _add_daily_user(session, user_id, now.date())
+            session.commit()
+
+
+async def save_user_data(user_id, data, result=None):
+    """
+    Добавляет в историю пользователя запись с ответами анкеты.
+
+    :param user_id: ID пользователя в Telegram
+    :param data: Данные FSM
+    :param result: CalculationResult, если анкета заполнена полностью
+    """
+    await run_db(_save_user_data, user_id, data, result)
+
+
+def _get_latest_user_data(user_id):
+    with Session() as session:
+        return session.query(UserData).join(
+            UserLatest, UserLatest.user_data_id == UserData.id
+        ).filter(UserLatest.user_id == user_id).first()
+
+
+async def get_latest_user_data(user_id):
+    """
+    Последняя запись пользователя: два поиска по первичному ключу.
+    """
+    return await run_db(_get_latest_user_data, user_id)
+
+
+def _get_user_history(user_id, limit):
+    with Session() as session:
+        return session.query(UserData).filter_by(
+            user_id=user_id).order_by(UserData.id.desc()).limit(limit).all()
+
+
+async def get_user_history(user_id, limit):
+    """
+    Последние limit расчетов пользователя, от новых к старым.
+    """
+    return await run_db(_get_user_history, user_id, limit)
+
+
+def _count_unique_users(start, end):
+    """
+    Считает уникальных пользователей за дни [start, end) по дневным
+    наборам, не обращаясь к user_data.
+    """
+    with Session() as session:
+        rows = session.query(DailyUsers).filter(
+            DailyUsers.day >= start.date(),
+            DailyUsers.day < end.date()
+        ).all()
+    if len(rows) == 1:
+        return rows[0].users_count
+    user_ids = set()
+    for row in rows:
+        ids = array('q')
+        ids.frombytes(row.user_ids)
+        user_ids.update(ids)
+    return len(user_ids)
+
+
+async def count_unique_users(start, end):
+    """
+    Число уникальных пользователей за дни [start, end). Наборы за прошедшие
+    дни больше не меняются, поэтому ответы по закрытым периодам кэшируются.
+    """
+    key = (start.date(), end.date())
+    cached = _stats_cache.get(key)
+    if cached is not None:
+        users_count, cached_at = cached
+        if time.monotonic() - cached_at <= STATS_CACHE_TTL:
+            _stats_cache.move_to_end(key)
+            return users_count
+        del _stats_cache[key]
+
+    users_count = await run_db(_count_unique_users, start, end)
+    if end.date() <= date.today():
+        _stats_cache[key] = (users_count, time.monotonic())
+        while len(_stats_cache) > STATS_CACHE_SIZE:
+            _stats_cache.popitem(last=False)
+    return users_count
@@ -0,0 +1,80 @@
+"""
+Общий для всего процесса движок SQLAlchemy и фабрика сессий.
+
+SQLite работает в режиме WAL: чтение (статистика, рассылка, выгрузка)
+идет из снимка базы и не блокирует запись анкет, а запись не ждет
+окончания чтения. Одновременно пишет только одно соединение, остальные
+ждут освобождения базы до DB_BUSY_TIMEOUT вместо немедленной ошибки
+"database is locked".
+"""
+from decouple import Config, RepositoryEnv
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+config = Config(RepositoryEnv('.env'))
+DATABASE_URL = config('DATABASE_URL', default='sqlite:///user_data.db')
+# Сколько миллисекунд соединение ждет, пока другое закончит запись
+DB_BUSY_TIMEOUT = config('DB_BUSY_TIMEOUT', default=5000, cast=int)
+# NORMAL в режиме WAL не теряет целостность базы при сбое, но последние
+# транзакции могут откатиться при отключении питания; FULL - надежнее
+# и медленнее
+DB_SYNCHRONOUS = config('DB_SYNCHRONOUS', default='NORMAL')
+# Постоянные соединения пула: не меньше потоков database.DB_WORKERS,
+# плюс основной поток, в котором выполняются init_db и /ready
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=5, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=5, cast=int)
+# Кэш страниц на соединение, в килобайтах
+DB_CACHE_KB = 8 * 1024
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def _is_file_database(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (
+        None, '', ':memory:')
+
+
+def make_engine(database_url=DATABASE_URL):
+    """
+    Создает движок; для файловой SQLite включает WAL и пул соединений.
+    """
+    url = make_url(database_url)
+    if not _is_file_database(url):
+        return create_engine(url)
+
+    synchronous = DB_SYNCHRONOUS.upper()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(
+            f"DB_SYNCHRONOUS должен быть одним из {SYNCHRONOUS_LEVELS}")
+
+    engine = create_engine(
+        url,
+        # Соединения переходят между потоками db_executor через пул
+        connect_args={
+            'check_same_thread': False,
+            'timeout': DB_BUSY_TIMEOUT / 1000,
+        },
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+    )
+
+    @event.listens_for(engine, 'connect')
+    def configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # Режим WAL хранится в файле базы, остальные настройки
+            # действуют только на текущее соединение
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT}')
+            cursor.execute(f'PRAGMA synchronous={synchronous}')
+            cursor.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+            cursor.execute('PRAGMA temp_store=MEMORY')
+        finally:
+            cursor.close()
+
+    return engine
+
+
+engine = make_engine()
+Session = sessionmaker(bind=engine)
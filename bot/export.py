@@ -0,0 +1,188 @@
+"""
+Выгрузка анкет и лидов в файл для администратора.
+
+Записи читаются из БД пачками по первичному ключу, каждая пачка в своей
+короткой транзакции, и сразу дописываются во временный файл, поэтому
+память не растет с размером таблицы, а чтение не держит блокировку БД.
+"""
+import csv
+import gzip
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from database import Session
+from models import UserData, CrmOutbox
+
+EXPORT_CHUNK_SIZE = 2000
+# Ограничение Telegram на размер документа, отправляемого ботом
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+FORMATS = ('csv', 'jsonl')
+DATASETS = ('calculations', 'leads')
+TARIFFS = ('lite', 'standard', 'enterprise')
+
+CALCULATION_COLUMNS = (
+    'id', 'user_id', 'timestamp', 'organization_name', 'license_type',
+    'tariff_name', 'employee_count', 'hr_specialist_count',
+    'documents_per_employee', 'pages_per_document', 'turnover_percentage',
+    'working_minutes_per_month', 'average_salary', 'courier_delivery_cost',
+    'hr_delivery_percentage', 'total_paper_costs', 'total_logistics_costs',
+    'total_operations_costs', 'total_license_costs',
+)
+LEAD_COLUMNS = (
+    'id', 'created_at', 'status', 'attempts', 'sent_at', 'lead_id',
+    'last_error', 'name', 'phone', 'email', 'comments',
+)
+
+USAGE = (
+    "Использование: /export [csv|jsonl] [leads] [с ДД.ММ.ГГГГ] "
+    "[по ДД.ММ.ГГГГ] [lite|standard|enterprise]\n"
+    "csv - таблица для Excel, jsonl - JSON Lines в gzip.\n"
+    "Без leads выгружаются анкеты, даты включительно."
+)
+
+
+class ExportRequest:
+    """
+    Параметры выгрузки из аргументов команды /export.
+    """
+    __slots__ = ('dataset', 'format', 'start', 'end', 'tariff')
+
+    def __init__(self, dataset='calculations', format='csv',
+                 start=None, end=None, tariff=None):
+        self.dataset = dataset
+        self.format = format
+        self.start = start
+        self.end = end
+        self.tariff = tariff
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :raises ValueError: если аргументы не распознаны
+        """
+        request = cls()
+        dates = []
+        for token in (text or '').lower().split():
+            if token in FORMATS:
+                request.format = token
+            elif token in DATASETS:
+                request.dataset = token
+            elif token in TARIFFS:
+                request.tariff = token
+            elif token in ('с', 'по', 'from', 'to'):
+                continue
+            else:
+                dates.append(datetime.strptime(token, '%d.%m.%Y'))
+        if len(dates) > 2:
+            raise ValueError('Слишком много дат')
+        if dates:
+            request.start = dates[0]
+        if len(dates) == 2:
+            # Конечная дата включительно
+            request.end = dates[1] + timedelta(days=1)
+        if request.dataset == 'leads' and request.tariff:
+            raise ValueError('Для лидов фильтр по тарифу не поддерживается')
+        return request
+
+    @property
+    def filename(self):
+        suffix = '.csv' if self.format == 'csv' else '.jsonl.gz'
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        return f"{self.dataset}-{stamp}{suffix}"
+
+
+def _calculation_record(row):
+    return dict(zip(CALCULATION_COLUMNS, row))
+
+
+def _lead_record(row):
+    outbox_id, created_at, status, attempts, sent_at, lead_id, \
+        last_error, payload = row
+    fields = json.loads(payload)
+    phones = fields.get('PHONE') or [{}]
+    emails = fields.get('EMAIL') or [{}]
+    return {
+        'id': outbox_id, 'created_at': created_at, 'status': status,
+        'attempts': attempts, 'sent_at': sent_at, 'lead_id': lead_id,
+        'last_error': last_error, 'name': fields.get('NAME'),
+        'phone': phones[0].get('VALUE'), 'email': emails[0].get('VALUE'),
+        'comments': fields.get('COMMENTS'),
+    }
+
+
+def _query(request):
+    if request.dataset == 'leads':
+        model = CrmOutbox
+        columns = [
+            CrmOutbox.id, CrmOutbox.created_at, CrmOutbox.status,
+            CrmOutbox.attempts, CrmOutbox.sent_at, CrmOutbox.lead_id,
+            CrmOutbox.last_error, CrmOutbox.payload,
+        ]
+        moment = CrmOutbox.created_at
+    else:
+        model = UserData
+        columns = [getattr(UserData, name) for name in CALCULATION_COLUMNS]
+        moment = UserData.timestamp
+    query = select(*columns)
+    if request.start:
+        query = query.where(moment >= request.start)
+    if request.end:
+        query = query.where(moment < request.end)
+    if request.tariff:
+        query = query.where(UserData.license_type == request.tariff)
+    return model, query
+
+
+def _iter_records(request, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Записи выгрузки пачками по chunk_size с продолжением по id.
+    """
+    model, query = _query(request)
+    to_record = (
+        _lead_record if request.dataset == 'leads' else _calculation_record)
+    last_id = 0
+    while True:
+        with Session() as session:
+            rows = session.execute(
+                query.where(model.id > last_id)
+                .order_by(model.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        for row in rows:
+            yield to_record(row)
+        last_id = rows[-1][0]
+
+
+def write_export(request):
+    """
+    Пишет выгрузку во временный файл.
+
+    :return: (путь к файлу, число записей); файл удаляет вызывающий
+    """
+    columns = LEAD_COLUMNS if request.dataset == 'leads' else (
+        CALCULATION_COLUMNS)
+    descriptor, path = tempfile.mkstemp(prefix='export-')
+    os.close(descriptor)
+    count = 0
+    try:
+        if request.format == 'csv':
+            # utf-8-sig, чтобы Excel правильно открыл кириллицу
+            with open(path, 'w', newline='', encoding='utf-8-sig') as file:
+                writer = csv.DictWriter(file, fieldnames=columns)
+                writer.writeheader()
+                for record in _iter_records(request):
+                    writer.writerow(record)
+                    count += 1
+        else:
+            with gzip.open(path, 'wt', encoding='utf-8') as file:
+                for record in _iter_records(request):
+                    file.write(json.dumps(
+                        record, ensure_ascii=False, default=str) + '\n')
+                    count += 1
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,16 @@
+from aiogram.filters import BaseFilter
+from aiogram.types import Message, CallbackQuery
+from decouple import Config, RepositoryEnv, Csv
+
+config = Config(RepositoryEnv('.env'))
+# Telegram ID администраторов через запятую
+ADMIN_IDS = set(config('ADMIN_IDS', default='', cast=Csv(int)))
+
+
+class IsAdmin(BaseFilter):
+    """
+    Пропускает только сообщения и нажатия кнопок администраторов.
+    """
+    async def __call__(self, event: Message | CallbackQuery) -> bool:
+        return event.from_user is not None and (
+            event.from_user.id in ADMIN_IDS)
@@ -1,29 +1,307 @@
-import matplotlib.pyplot as plt
+import asyncio
+import io
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from decouple import Config, RepositoryEnv
 
+config = Config(RepositoryEnv('.env'))
+# Чем рисовать график расходов: matplotlib или pillow (быстрее и легче,
+# см. bench_charts.py)
+CHART_RENDERER = config('CHART_RENDERER', default='matplotlib')
 
-def generate_cost_graph(
+# Число процессов для отрисовки графиков
+RENDER_WORKERS = 2
+# Сколько секунд запрос графика может ждать свободного процесса
+RENDER_WAIT_TIMEOUT = 30
+# Сколько графиков может одновременно ждать свободного процесса: с большим
+# запасом над всплесками из loadtest.py, но с ограничением, чтобы очередь
+# не росла без предела
+RENDER_MAX_WAITING = 256
+# Сколько готовых графиков хранить и как долго (в секундах)
+CHART_CACHE_SIZE = 256
+CHART_CACHE_TTL = 24 * 60 * 60
+
+_executor = None
+# Свободные процессы отрисовки; остальные запросы ждут своей очереди
+_slots = asyncio.Semaphore(RENDER_WORKERS)
+_waiting = 0
+_rendering = {}
+
+
+class RenderTimeout(Exception):
+    """
+    Процесс отрисовки не освободился за RENDER_WAIT_TIMEOUT или очередь
+    ожидания заполнена, график не будет построен.
+    """
+
+
+class CachedChart:
+    """
+    Готовый график: PNG до первой отправки, затем только file_id Telegram.
+    """
+    __slots__ = ('key', 'png', 'file_id', 'created_at')
+
+    def __init__(self, key, png):
+        self.key = key
+        self.png = png
+        self.file_id = None
+        self.created_at = time.monotonic()
+
+
+class ChartCache:
+    """
+    LRU-кэш графиков с ограничением по размеру и времени жизни.
+    """
+    def __init__(self, max_size=CHART_CACHE_SIZE, ttl=CHART_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        chart = self._items.get(key)
+        if chart is None:
+            return None
+        if time.monotonic() - chart.created_at > self.ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return chart
+
+    def put(self, key, png):
+        chart = CachedChart(key, png)
+        self._items[key] = chart
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return chart
+
+    def set_file_id(self, key, file_id):
+        chart = self._items.get(key)
+        if chart is not None:
+            # После загрузки в Telegram график отправляется по ссылке,
+            # поэтому PNG больше не нужно держать в памяти
+            chart.file_id = file_id
+            chart.png = None
+
+    def forget_file_id(self, key):
+        self._items.pop(key, None)
+
+
+chart_cache = ChartCache()
+
+
+def cost_graph_key(current_kdp_costs, kedo_costs):
+    """
+    Ключ кэша: значения столбцов с точностью отображения (до рубля).
+    """
+    return round(current_kdp_costs), round(kedo_costs)
+
+
+def render_cost_graph(current_kdp_costs, kedo_costs):
+    """
+    Рисует график в PNG и возвращает его байты.
+    Выполняется в процессе пула, поэтому использует только объектный
+    API Figure без глобального состояния pyplot и временных файлов.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.bar(
+        ['Текущий КДП', 'КЭДО от HRlink'],
+        [current_kdp_costs, kedo_costs], color=['green', 'blue']
+        )
+    ax.set_xlabel('Категории расходов')
+    ax.set_ylabel('Стоимость (руб.)')
+    ax.set_title('Сравнение текущих расходов на КДП и КЭДО от HRlink')
+    ax.grid(True)
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def render_tariff_comparison(
+        employee_counts, savings_by_tariff, current_employee_count):
+    """
+    Рисует график экономии по тарифам в зависимости от численности
+    сотрудников и возвращает PNG.
+
+    :param savings_by_tariff: [(название тарифа, [экономия для каждого
+        значения employee_counts])]
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import FuncFormatter
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    for name, savings in savings_by_tariff:
+        ax.plot(employee_counts, savings, marker='o', label=name)
+    ax.axhline(0, color='gray', linewidth=1)
+    ax.axvline(
+        current_employee_count, color='gray', linestyle='--',
+        label='Ваша численность')
+    ax.yaxis.set_major_formatter(FuncFormatter(
+        lambda value, _: f'{value:,.0f}'.replace(',', ' ')))
+    ax.set_xlabel('Число сотрудников')
+    ax.set_ylabel('Экономия (руб. в год)')
+    ax.set_title('Экономия с HRlink по тарифам')
+    ax.grid(True)
+    ax.legend()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def get_cost_graph_renderer():
+    """
+    Функция отрисовки графика расходов, выбранная в CHART_RENDERER.
+    """
+    if CHART_RENDERER == 'pillow':
+        from chart_pillow import render_cost_graph as render_with_pillow
+        return render_with_pillow
+    return render_cost_graph
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Процессы отрисовки порождаются от forkserver, в который заранее
+        # загружены только выбранный модуль отрисовки и этот модуль,
+        # а не весь бот
+        preload = 'chart_pillow' if CHART_RENDERER == 'pillow' else (
+            'matplotlib.figure')
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([preload, 'graph'])
+        _executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=context)
+    return _executor
+
+
+async def warm_up_render_pool():
+    """
+    Запускает процессы отрисовки и рисует пробный график, чтобы первый
+    пользователь не ждал загрузки библиотек и шрифтов.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    render = get_cost_graph_renderer()
+    await asyncio.gather(*(
+        loop.run_in_executor(executor, render, 1, 1)
+        for _ in range(RENDER_WORKERS)
+    ))
+
+
+def shutdown_render_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def generate_cost_graph(
         total_paper_costs, total_logistics_costs,
         total_operations_costs, total_license_costs):
+    """
+    Возвращает график из кэша или строит его в пуле процессов,
+    не блокируя event loop.
+
+    :return: CachedChart с PNG или с file_id уже загруженного графика
+    :raises RenderTimeout: если очередь отрисовки заполнена или график
+        не дождался свободного процесса
+    """
     # Данные для графика
     current_kdp_costs = (
         total_paper_costs + total_logistics_costs + total_operations_costs
         )
     kedo_costs = total_license_costs
 
-    # Создание графика
-    plt.figure(figsize=(10, 6))
-    plt.bar(
-        ['Текущий КДП', 'КЭДО от HRlink'],
-        [current_kdp_costs, kedo_costs], color=['green', 'blue']
-        )
-    plt.xlabel('Категории расходов')
-    plt.ylabel('Стоимость (руб.)')
-    plt.title('Сравнение текущих расходов на КДП и КЭДО от HRlink')
-    plt.grid(True)
+    # Метрики импортируются здесь, чтобы процессы отрисовки, в которые
+    # заранее загружается этот модуль, не тянули aiohttp и aiogram
+    from metrics import CHART_REQUESTS
+
+    key = cost_graph_key(current_kdp_costs, kedo_costs)
+    chart = chart_cache.get(key)
+    if chart is not None:
+        CHART_REQUESTS.inc(result='cache')
+        return chart
+
+    # Одинаковые графики, запрошенные одновременно, рисуются один раз
+    future = _rendering.get(key)
+    if future is None:
+        CHART_REQUESTS.inc(result='rendered')
+        future = asyncio.ensure_future(_render(key))
+        _rendering[key] = future
+        future.add_done_callback(lambda _: _rendering.pop(key, None))
+    else:
+        CHART_REQUESTS.inc(result='shared')
+    return await asyncio.shield(future)
+
+
+async def generate_tariff_comparison(
+        employee_counts, savings_by_tariff, current_employee_count):
+    """
+    Строит график сравнения тарифов в пуле процессов. Такие графики
+    индивидуальны, поэтому не кэшируются.
+
+    :return: PNG
+    :raises RenderTimeout: если очередь отрисовки заполнена или график
+        не дождался свободного процесса
+    """
+    from metrics import CHART_REQUESTS
+
+    CHART_REQUESTS.inc(result='rendered')
+    return await _render_in_pool(
+        render_tariff_comparison, employee_counts, savings_by_tariff,
+        current_employee_count)
+
+
+async def _render_in_pool(func, *args):
+    from metrics import CHART_RENDER_SECONDS
+
+    started = time.perf_counter()
+    await _acquire_slot()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), func, *args)
+    finally:
+        _slots.release()
+        CHART_RENDER_SECONDS.observe(time.perf_counter() - started)
+
+
+async def _acquire_slot():
+    """
+    Занимает процесс отрисовки. Ожидающий запрос хранит только аргументы
+    отрисовки, поэтому при всплеске запросы ждут очереди, но не дольше
+    RENDER_WAIT_TIMEOUT и не больше RENDER_MAX_WAITING одновременно.
+
+    :raises RenderTimeout: если очередь заполнена или ожидание истекло
+    """
+    from metrics import CHART_REQUESTS
+
+    global _waiting
+    if not _slots.locked():
+        await _slots.acquire()
+        return
+    if _waiting >= RENDER_MAX_WAITING:
+        CHART_REQUESTS.inc(result='rejected')
+        raise RenderTimeout()
+    _waiting += 1
+    try:
+        await asyncio.wait_for(_slots.acquire(), timeout=RENDER_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        CHART_REQUESTS.inc(result='timeout')
+        raise RenderTimeout() from None
+    finally:
+        _waiting -= 1
 
-    # Сохранение графика в файл
-    graph_path = 'cost_graph.png'
-    plt.savefig(graph_path)
-    plt.close()
 
-    return graph_path
+async def _render(key):
+    png = await _render_in_pool(get_cost_graph_renderer(), *key)
+    return chart_cache.put(key, png)
@@ -3,74 +3,100 @@ from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton
 )
-from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram.filters import (
+    CommandStart, Command, CommandObject, StateFilter
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
-from aiogram.types.input_file import FSInputFile
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import UserData, LicenseCosts
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types.input_file import BufferedInputFile, FSInputFile
 from states import Form
 from keyboards import (
     get_start_keyboard, get_contact_keyboard,
     get_license_type_keyboard, get_confirmation_keyboard,
     get_retry_keyboard
 )
-from calculations import (
-    calculate_documents_per_year, calculate_pages_per_year,
-    calculate_total_paper_costs, calculate_total_logistics_costs,
-    calculate_cost_per_minute, calculate_total_operations_costs,
-    calculate_total_license_costs
+from calculations import CalculationResult, calculate_costs
+from database import (
+    user_exists as db_user_exists, save_user_data, get_latest_user_data,
+    get_user_history, count_unique_users, run_db
+)
+from coefficients import (
+    get_cost_coefficients, reload_cost_coefficients, COEFFICIENTS_TTL
 )
+from filters import IsAdmin
 from decouple import Config, RepositoryEnv
-from graph import generate_cost_graph
+from graph import (
+    generate_cost_graph, generate_tariff_comparison, chart_cache,
+    RenderTimeout
+)
 import os
-import aiohttp
 import re
 from datetime import datetime, timedelta
-from broadcast import send_broadcast
+from broadcast import start_broadcast
+from crm import enqueue_lead, get_queue_depth
+from notifications import NotificationDispatcher
+from metrics import instrument_bot
+from export import (
+    ExportRequest, write_export, EXPORT_MAX_BYTES, USAGE as EXPORT_USAGE
+)
+from profiler import (
+    capture_profile, ProfileBusy, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS
+)
 import logging
 
 config = Config(RepositoryEnv('.env'))
 BOT_TOKEN = config('BOT_TOKEN')
 CHAT_ID = config('CHAT_ID')
-bot = Bot(token=BOT_TOKEN)
-
-engine = create_engine('sqlite:///user_data.db')
-Session = sessionmaker(bind=engine)
+bot = instrument_bot(Bot(token=BOT_TOKEN))
+notifier = NotificationDispatcher(bot, CHAT_ID)
+# Сколько последних расчетов показывать по /history
+HISTORY_SIZE = 5
+CHART_SKIPPED_TEXT = (
+    "Сейчас много расчетов, поэтому график построить не удалось. "
+    "Все цифры приведены ниже.")
 
 
 def register_handlers(dp: Dispatcher):
+    dp.shutdown.register(notifier.stop)
+
     dp.message.register(cmd_start, CommandStart())
-    dp.message.register(cmd_users, Command("users"))
-    dp.message.register(cmd_broadcast, Command("broadcast"))
+    dp.message.register(cmd_history, Command("history"))
+    dp.message.register(cmd_users, Command("users"), IsAdmin())
+    dp.message.register(cmd_broadcast, Command("broadcast"), IsAdmin())
+    dp.message.register(
+        cmd_reload_prices, Command("reload_prices"), IsAdmin())
+    dp.message.register(cmd_recompute, Command("recompute"), IsAdmin())
+    dp.message.register(cmd_crm_queue, Command("crm_queue"), IsAdmin())
+    dp.message.register(cmd_profile, Command("profile"), IsAdmin())
+    dp.message.register(cmd_export, Command("export"), IsAdmin())
 
     dp.callback_query.register(
-        process_users_day, lambda c: c.data == "users_day"
-        )
+        process_users_day, lambda c: c.data == "users_day",
+        IsAdmin())
     dp.callback_query.register(
-        process_users_week, lambda c: c.data == "users_week"
-        )
+        process_users_week, lambda c: c.data == "users_week",
+        IsAdmin())
     dp.callback_query.register(
-        process_users_month, lambda c: c.data == "users_month"
-        )
+        process_users_month, lambda c: c.data == "users_month",
+        IsAdmin())
     dp.callback_query.register(
-        process_users_quarter, lambda c: c.data == "users_quarter"
-        )
+        process_users_quarter, lambda c: c.data == "users_quarter",
+        IsAdmin())
     dp.callback_query.register(
-        process_users_year, lambda c: c.data == "users_year"
-        )
+        process_users_year, lambda c: c.data == "users_year",
+        IsAdmin())
 
     dp.message.register(process_day_input, StateFilter(
-        Form.waiting_for_day))
+        Form.waiting_for_day), IsAdmin())
     dp.message.register(process_week_input, StateFilter(
-        Form.waiting_for_week))
+        Form.waiting_for_week), IsAdmin())
     dp.message.register(process_month_input, StateFilter(
-        Form.waiting_for_month))
+        Form.waiting_for_month), IsAdmin())
     dp.message.register(process_quarter_input, StateFilter(
-        Form.waiting_for_quarter))
+        Form.waiting_for_quarter), IsAdmin())
     dp.message.register(process_year_input, StateFilter(
-        Form.waiting_for_year))
+        Form.waiting_for_year), IsAdmin())
     dp.callback_query.register(start_form, lambda c: c.data == "start_form")
     dp.message.register(
         restart_form, lambda message: message.text.lower() == 'заново')
@@ -102,6 +128,8 @@ def register_handlers(dp: Dispatcher):
         process_hr_delivery_percentage, StateFilter(
             Form.hr_delivery_percentage))
     dp.callback_query.register(contact_me, lambda c: c.data == "contact_me")
+    dp.callback_query.register(
+        compare_tariffs, lambda c: c.data == "compare_tariffs")
     dp.message.register(process_contact_name, StateFilter(Form.contact_name))
     dp.message.register(process_contact_phone, StateFilter(Form.contact_phone))
     dp.message.register(process_contact_email, StateFilter(Form.contact_email))
@@ -113,7 +141,101 @@ def register_handlers(dp: Dispatcher):
 
 
 async def cmd_broadcast(message: Message):
-    await send_broadcast(bot)  # Передаем экземпляр bot напрямую
+    # Рассылка идет в фоне, отчет придет в этот чат по завершении
+    if start_broadcast(bot, report_chat_id=message.chat.id):
+        await message.answer("Рассылка запущена.")
+    else:
+        await message.answer("Рассылка уже идет.")
+
+
+async def cmd_reload_prices(message: Message):
+    """
+    Перечитывает цены из БД без перезапуска бота. Сразу обновляется только
+    процесс, получивший команду; остальные воркеры многопроцессного
+    режима перечитывают цены сами не позже чем через COEFFICIENTS_TTL.
+    """
+    coefficients = await reload_cost_coefficients()
+    await message.answer(
+        f"Цены перечитаны, версия коэффициентов: {coefficients.version}.\n"
+        f"Если бот запущен в несколько процессов, остальные подхватят "
+        f"новые цены в течение {COEFFICIENTS_TTL} с.")
+
+
+async def cmd_recompute(message: Message):
+    """
+    Пересчитывает сохраненные итоги всех анкет по текущим ценам.
+    """
+    # NumPy загружается только при первом пересчете
+    from batch import recompute_all_totals
+
+    coefficients = await reload_cost_coefficients()
+    updated, elapsed = await run_db(recompute_all_totals, coefficients)
+    await message.answer(
+        f"Пересчитано анкет: {updated} за {elapsed:.2f} с "
+        f"(версия коэффициентов: {coefficients.version})")
+
+
+async def cmd_crm_queue(message: Message):
+    depth = await get_queue_depth()
+    await message.answer(
+        f"Лидов в очереди на отправку в Битрикс24: {depth['pending']}\n"
+        f"Не удалось отправить: {depth['failed']}")
+
+
+async def cmd_profile(message: Message, command: CommandObject):
+    """
+    Снимает профиль CPU и памяти работающего бота: /profile [секунды].
+    """
+    args = (command.args or '').strip()
+    if args and not args.isdigit():
+        await message.answer("Использование: /profile [секунды]")
+        return
+    seconds = min(
+        int(args) if args else PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS)
+
+    await message.answer(f"Профилирование {seconds} с...")
+    try:
+        result = await capture_profile(seconds)
+    except ProfileBusy:
+        await message.answer("Профилирование уже идет.")
+        return
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    await message.answer_document(
+        BufferedInputFile(result.cpu_report, f"cpu-{stamp}.txt"),
+        caption=f"Профиль CPU, снимков: {result.samples}")
+    await message.answer_document(BufferedInputFile(
+        result.collapsed_stacks, f"cpu-{stamp}.collapsed"))
+    await message.answer_document(
+        BufferedInputFile(result.memory_report, f"memory-{stamp}.txt"),
+        caption="Топ выделений памяти (tracemalloc)")
+
+
+async def cmd_export(message: Message, command: CommandObject):
+    """
+    Выгружает анкеты или лиды в файл и отправляет его документом.
+    """
+    try:
+        request = ExportRequest.parse(command.args)
+    except ValueError:
+        await message.answer(EXPORT_USAGE)
+        return
+
+    await message.answer("Готовлю выгрузку...")
+    path, count = await run_db(write_export, request)
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await message.answer(
+                f"Файл выгрузки слишком большой для Telegram "
+                f"({size / 1024 / 1024:.0f} МБ). Сузьте период или "
+                "выберите формат jsonl.")
+            return
+        await message.answer_document(
+            FSInputFile(path, filename=request.filename),
+            caption=f"Записей: {count}")
+    finally:
+        os.remove(path)
 
 
 async def cmd_start(message: Message):
@@ -122,9 +244,7 @@ async def cmd_start(message: Message):
     print(
         f"Пользователь нажал /start. user_id: {user_id}, username: {username}"
         )
-    session = Session()
-    user_exists = session.query(UserData).filter_by(user_id=user_id).first()
-    session.close()
+    user_exists = await db_user_exists(user_id)
 
     if not user_exists:
         try:
@@ -138,11 +258,53 @@ async def cmd_start(message: Message):
         " бот посчитает разницу между бумажным и электронным "
         "кадровым документооборотом 💰\n"
     )
+    if user_exists:
+        user_text += "\nВаши прошлые расчеты: /history\n"
     await message.answer(
         text=user_text, reply_markup=get_start_keyboard(),
         parse_mode=ParseMode.HTML)
 
 
+async def cmd_history(message: Message):
+    """
+    Последние расчеты пользователя для сравнения сценариев.
+    """
+    entries = await get_user_history(message.from_user.id, HISTORY_SIZE)
+    # Незавершенные анкеты без итогов не показываем
+    entries = [
+        (entry, CalculationResult.from_row(entry)) for entry in entries
+    ]
+    entries = [(entry, result) for entry, result in entries if result]
+    if not entries:
+        await message.answer(
+            "У вас пока нет сохраненных расчетов.",
+            reply_markup=get_start_keyboard())
+        return
+
+    lines = ["<b>ВАШИ ПОСЛЕДНИЕ РАСЧЕТЫ</b>\n"]
+    for index, (entry, result) in enumerate(entries):
+        lines.append(
+            f"<b>{entry.timestamp:%d.%m.%Y %H:%M}</b>, "
+            f"<u>{entry.tariff_name}</u>\n"
+            f"Сотрудников: {entry.employee_count}, "
+            f"кадровых специалистов: {entry.hr_specialist_count}\n"
+            f"Бумажное КДП: {format_number(result.current_costs)} руб., "
+            f"HRlink: от {format_number(result.total_license_costs)} руб.\n"
+            f"Экономия: <b>{format_number(result.savings)}</b> руб. в год")
+        if index + 1 < len(entries):
+            previous = entries[index + 1][1]
+            difference = result.savings - previous.savings
+            if round(difference):
+                sign = '+' if difference > 0 else '−'
+                lines[-1] += (
+                    f" ({sign}{format_number(abs(difference))} руб. "
+                    "к предыдущему расчету)")
+        lines[-1] += "\n"
+    await message.answer(
+        "\n".join(lines), reply_markup=get_start_keyboard(),
+        parse_mode=ParseMode.HTML)
+
+
 async def cmd_users(message: Message):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="День", callback_data="users_day")],
@@ -168,12 +330,8 @@ async def process_day_input(message: Message, state: FSMContext):
         date = datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(selected_date=date)
 
-        session = Session()
-        users_count = session.query(UserData).filter(
-            UserData.timestamp >= date,
-            UserData.timestamp < date + timedelta(days=1)
-        ).distinct(UserData.user_id).count()
-        session.close()
+        users_count = await count_unique_users(
+            date, date + timedelta(days=1))
 
         await message.answer(
             f"Количество уникальных пользователей за {
@@ -200,12 +358,7 @@ async def process_week_input(message: Message, state: FSMContext):
         start_of_week = datetime.fromisocalendar(year, week, 1)
         end_of_week = start_of_week + timedelta(weeks=1)
 
-        session = Session()
-        users_count = session.query(UserData).filter(
-            UserData.timestamp >= start_of_week,
-            UserData.timestamp < end_of_week
-        ).distinct(UserData.user_id).count()
-        session.close()
+        users_count = await count_unique_users(start_of_week, end_of_week)
 
         await message.answer(
             f"Количество уникальных пользователей за {week} "
@@ -236,12 +389,7 @@ async def process_month_input(message: Message, state: FSMContext):
         end_of_month = datetime(
             year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
 
-        session = Session()
-        users_count = session.query(UserData).filter(
-            UserData.timestamp >= start_of_month,
-            UserData.timestamp < end_of_month
-        ).distinct(UserData.user_id).count()
-        session.close()
+        users_count = await count_unique_users(start_of_month, end_of_month)
 
         await message.answer(
             f"Количество уникальных пользователей за {month} "
@@ -274,12 +422,8 @@ async def process_quarter_input(message: Message, state: FSMContext):
             year, 3 * quarter + 1, 1
             ) if quarter < 4 else datetime(year + 1, 1, 1)
 
-        session = Session()
-        users_count = session.query(UserData).filter(
-            UserData.timestamp >= start_of_quarter,
-            UserData.timestamp < end_of_quarter
-        ).distinct(UserData.user_id).count()
-        session.close()
+        users_count = await count_unique_users(
+            start_of_quarter, end_of_quarter)
 
         await message.answer(
             f"Количество уникальных пользователей за {quarter} "
@@ -304,12 +448,7 @@ async def process_year_input(message: Message, state: FSMContext):
         start_of_year = datetime(year, 1, 1)
         end_of_year = datetime(year + 1, 1, 1)
 
-        session = Session()
-        users_count = session.query(UserData).filter(
-            UserData.timestamp >= start_of_year,
-            UserData.timestamp < end_of_year
-        ).distinct(UserData.user_id).count()
-        session.close()
+        users_count = await count_unique_users(start_of_year, end_of_year)
 
         await message.answer(
             f"Количество уникальных пользователей за {year} год: {users_count}"
@@ -323,27 +462,13 @@ async def process_year_input(message: Message, state: FSMContext):
 
 async def send_new_user_notification(user_id: int, username: str):
     """
-    Отправляет уведомление о новом пользователе в указанный чат.
+    Ставит уведомление о новом пользователе в очередь чата менеджеров.
 
     :param user_id: ID пользователя в Telegram
     :param username: Имя пользователя в Telegram
     """
-    notification_text = (
-        "🚀 <b>Новый пользователь!</b>\n"
-        f"<b>ID:</b> {user_id}\n"
-        f"<b>Имя пользователя:</b> @{username}\n"
-        f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-
-    try:
-        await bot.send_message(
-            chat_id=CHAT_ID,
-            text=notification_text,
-            parse_mode=ParseMode.HTML
-        )
-        logging.info(f"Уведомление о новом пользователе отправлено: {user_id}")
-    except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления: {e}")
+    notifier.notify_new_user(user_id, username)
+    logging.info(f"Уведомление о новом пользователе в очереди: {user_id}")
 
 
 async def start_form(callback_query: CallbackQuery, state: FSMContext):
@@ -588,111 +713,107 @@ async def process_hr_delivery_percentage(message: Message, state: FSMContext):
 
 async def save_data(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
-    session = Session()
-
-    # Проверяем, существует ли запись для данного user_id
-    user_data = session.query(UserData).filter_by(
-        user_id=message.from_user.id).first()
-
-    if user_data:
-        # Если запись существует, обновляем её
-        user_data.organization_name = data.get(
-            'organization_name', 'Не указано')
-        user_data.employee_count = data.get(
-            'employee_count', None)
-        user_data.hr_specialist_count = data.get('hr_specialist_count', None)
-        user_data.license_type = data.get('license_type', 'standard')
-        user_data.tariff_name = data.get('tariff_name', 'HRlink Standard')
-        user_data.documents_per_employee = data.get(
-            'documents_per_employee', None)
-        user_data.pages_per_document = data.get('pages_per_document', None)
-        user_data.turnover_percentage = data.get('turnover_percentage', None)
-        user_data.average_salary = data.get('average_salary', None)
-        user_data.courier_delivery_cost = data.get(
-            'courier_delivery_cost', None)
-        user_data.hr_delivery_percentage = data.get(
-            'hr_delivery_percentage', 0)
-        user_data.timestamp = datetime.now()  # Обновляем время
-    else:
-        # Если записи нет, создаем новую
-        user_data = UserData(
-            user_id=message.from_user.id,
-            organization_name=data.get('organization_name', 'Не указано'),
-            employee_count=data.get('employee_count', None),
-            hr_specialist_count=data.get('hr_specialist_count', None),
-            license_type=data.get('license_type', 'standard'),
-            tariff_name=data.get('tariff_name', 'HRlink Standard'),
-            documents_per_employee=data.get('documents_per_employee', None),
-            pages_per_document=data.get('pages_per_document', None),
-            turnover_percentage=data.get('turnover_percentage', None),
-            average_salary=data.get('average_salary', None),
-            courier_delivery_cost=data.get('courier_delivery_cost', None),
-            hr_delivery_percentage=data.get('hr_delivery_percentage', 0),
-            timestamp=datetime.now()  # Устанавливаем текущее время
-        )
-        session.add(user_data)
-
-    # Сохраняем изменения в базе данных
-    session.commit()
 
     # Проверяем, все ли данные введены
-    if 'hr_delivery_percentage' in data:
-        # Расчеты
-        documents_per_year = calculate_documents_per_year(data)
-        pages_per_year = calculate_pages_per_year(data)
-        total_paper_costs = calculate_total_paper_costs(pages_per_year)
-        total_logistics_costs = calculate_total_logistics_costs(
-            data, documents_per_year)
-        cost_per_minute = calculate_cost_per_minute(data)
-        total_operations_costs = calculate_total_operations_costs(
-            data, documents_per_year, cost_per_minute)
-
-        # Расчет суммы по использованию нашего решения
-        license_costs = session.query(LicenseCosts).first()
-        total_license_costs = calculate_total_license_costs(
-            data, license_costs)
-
-        # Обновляем результаты расчетов в базе данных
-        user_data.total_paper_costs = total_paper_costs
-        user_data.total_logistics_costs = total_logistics_costs
-        user_data.total_operations_costs = total_operations_costs
-        user_data.total_license_costs = total_license_costs
-        session.commit()
-
-        # Добавляем результаты расчетов в data
-        data['total_paper_costs'] = total_paper_costs
-        data['total_logistics_costs'] = total_logistics_costs
-        data['total_operations_costs'] = total_operations_costs
-        data['total_license_costs'] = total_license_costs
-        data['timestamp'] = datetime.now()  # Добавляем текущее время
-
-        # Вывод результатов
-        results = (
-            f"<b>Число сотрудников:</b> {data.get(
-                'employee_count', 'Не указано')}\n"
-            f"<b>Число кадровых специалистов:</b> {data.get(
-                'hr_specialist_count', 'Не указано')}\n"
-            f"<b>Документов в год на сотрудника:</b> {data.get(
-                'documents_per_employee', 'Не указано')}\n"
-            f"<b>Страниц в документе:</b> {data.get(
-                'pages_per_document', 'Не указано')}\n"
-            f"<b>Текучка в процентах:</b> {data.get(
-                'turnover_percentage', 'Не указано')}%\n"
-            f"<b>Средняя зарплата:</b> {data.get(
-                'average_salary', 'Не указано')} руб.\n"
-            f"<b>Стоимость курьерской доставки:</b> {data.get(
-                'courier_delivery_cost', 'Не указано')} руб.\n"
-            f"<b>Процент отправки кадровых документов:</b> {data.get(
-                'hr_delivery_percentage', 'Не указано')}%\n"
-            "<b>Подходящий тариф:</b> "
-            f"<u>{get_tariff_name(data)}</u>\n"
-        )
+    if 'hr_delivery_percentage' not in data:
+        await save_user_data(message.from_user.id, data)
+        return
+
+    # Расчет по текущему снимку цен выполняется один раз: результат
+    # сохраняется в БД и в состоянии FSM для выводов после подтверждения
+    result = calculate_costs(data, await get_cost_coefficients())
+    await save_user_data(message.from_user.id, data, result)
+    await state.update_data(result=result.as_dict())
+
+    # Вывод результатов
+    results = (
+        f"<b>Число сотрудников:</b> {data.get(
+            'employee_count', 'Не указано')}\n"
+        f"<b>Число кадровых специалистов:</b> {data.get(
+            'hr_specialist_count', 'Не указано')}\n"
+        f"<b>Документов в год на сотрудника:</b> {data.get(
+            'documents_per_employee', 'Не указано')}\n"
+        f"<b>Страниц в документе:</b> {data.get(
+            'pages_per_document', 'Не указано')}\n"
+        f"<b>Текучка в процентах:</b> {data.get(
+            'turnover_percentage', 'Не указано')}%\n"
+        f"<b>Средняя зарплата:</b> {data.get(
+            'average_salary', 'Не указано')} руб.\n"
+        f"<b>Стоимость курьерской доставки:</b> {data.get(
+            'courier_delivery_cost', 'Не указано')} руб.\n"
+        f"<b>Процент отправки кадровых документов:</b> {data.get(
+            'hr_delivery_percentage', 'Не указано')}%\n"
+        "<b>Подходящий тариф:</b> "
+        f"<u>{get_tariff_name(data)}</u>\n"
+    )
+    await message.answer(
+        f"<b>Вы ввели следующие данные:</b>\n{results}",
+        reply_markup=get_confirmation_keyboard(),
+        parse_mode=ParseMode.HTML)
+
+
+async def compare_tariffs(callback_query: CallbackQuery):
+    """
+    Сравнивает все тарифы по последней анкете пользователя без повторного
+    прохождения вопросов.
+    """
+    # NumPy загружается только при первом сравнении
+    from compare import compare_tariffs as compute_comparison, TURNOVER_VALUES
+
+    message = callback_query.message
+    entry = await get_latest_user_data(callback_query.from_user.id)
+    if entry is None or CalculationResult.from_row(entry) is None:
         await message.answer(
-            f"<b>Вы ввели следующие данные:</b>\n{results}",
-            reply_markup=get_confirmation_keyboard(),
-            parse_mode=ParseMode.HTML)
+            "Сначала пройдите расчет, чтобы сравнить тарифы.",
+            reply_markup=get_start_keyboard())
+        return
 
-    session.close()
+    comparison = compute_comparison(entry, await get_cost_coefficients())
+    names = [name for name, *_ in comparison.by_tariff]
+
+    try:
+        png = await generate_tariff_comparison(
+            comparison.employee_counts,
+            list(zip(names, comparison.employee_savings)),
+            comparison.employee_count)
+        await message.answer_photo(
+            BufferedInputFile(png, filename='tariffs.png'))
+    except RenderTimeout:
+        logging.warning("Отрисовка перегружена, график тарифов не отправлен")
+        await message.answer(CHART_SKIPPED_TEXT)
+
+    rows = [f"{'Тариф':<18}{'HRlink':>12}{'Экономия':>13}"]
+    for name, available, current, license_costs, savings in (
+            comparison.by_tariff):
+        rows.append(
+            f"{name + ('' if available else '*'):<18}"
+            f"{format_number(license_costs):>12}"
+            f"{format_number(savings):>13}")
+    short_names = [name.replace('HRlink ', '') for name in names]
+    turnover_rows = [
+        f"{'Текучесть':<10}" + ''.join(f"{name:>12}" for name in short_names)
+    ]
+    for turnover, savings in zip(
+            TURNOVER_VALUES, comparison.turnover_savings):
+        turnover_rows.append(
+            f"{f'{turnover}%':<10}" +
+            ''.join(f"{format_number(value):>12}" for value in savings))
+
+    text = (
+        "<b>СРАВНЕНИЕ ТАРИФОВ</b>\n"
+        f"Сотрудников: {comparison.employee_count}, текучесть: "
+        f"{comparison.turnover_percentage:g}%. "
+        f"Бумажное КДП: {format_number(comparison.by_tariff[0][2])} "
+        "руб. в год.\n"
+        "\n"
+        f"<pre>{chr(10).join(rows)}</pre>\n"
+        "* тариф не предлагается для вашей численности сотрудников\n"
+        "\n"
+        "<b>Экономия при другой текучести, руб. в год:</b>\n"
+        f"<pre>{chr(10).join(turnover_rows)}</pre>"
+    )
+    await message.answer(
+        text, reply_markup=get_contact_keyboard(), parse_mode=ParseMode.HTML)
 
 
 async def contact_me(callback_query: CallbackQuery, state: FSMContext):
@@ -751,14 +872,11 @@ async def process_organization_name(message: Message, state: FSMContext):
 
 async def send_contact_data(state: FSMContext):
     data = await state.get_data()
-    session = Session()
 
     # Получаем последнюю запись из БД
-    user_data_entries = session.query(UserData).filter_by(
-        user_id=data['user_id']).order_by(UserData.timestamp.desc()).all()
-    session.close()
+    latest_entry = await get_latest_user_data(data['user_id'])
 
-    if not user_data_entries:
+    if latest_entry is None:
         await bot.send_message(
             chat_id=data['user_id'],
             text="<b>Ошибка: данные не найдены в базе данных.</b>",
@@ -766,7 +884,8 @@ async def send_contact_data(state: FSMContext):
         )
         return
 
-    latest_entry = user_data_entries[0]  # Берем последнюю запись
+    # Итоги расчета сохранены в записи вместе с анкетой
+    result = CalculationResult.from_row(latest_entry)
 
     # Формируем комментарии с данными из БД
     comments = (
@@ -784,11 +903,9 @@ async def send_contact_data(state: FSMContext):
         f"<b>Процент отправки кадровых документов:</b> {
             latest_entry.hr_delivery_percentage}%\n"
         f"<b>Сумма текущих трат на КДП на бумаге:</b> {format_number(
-            latest_entry.total_paper_costs +
-            latest_entry.total_logistics_costs +
-            latest_entry.total_operations_costs
-        ) if latest_entry.total_paper_costs is not None and latest_entry.total_logistics_costs is not None and latest_entry.total_operations_costs is not None else 'Неизвестно'} руб.\n"
-        f"<b>Сумма КЭДО от HRlink:</b> {format_number(latest_entry.total_license_costs) if latest_entry.total_license_costs is not None else 'Неизвестно'} руб.\n"
+            result.current_costs) if result else 'Неизвестно'} руб.\n"
+        f"<b>Сумма КЭДО от HRlink:</b> {format_number(
+            result.total_license_costs) if result else 'Неизвестно'} руб.\n"
         f"<b>Время расчета:</b> {latest_entry.timestamp}\n"
     )
 
@@ -802,13 +919,8 @@ async def send_contact_data(state: FSMContext):
         f"<b>Тип лицензии:</b> <u>{latest_entry.tariff_name}</u>\n"
     )
 
-    # Отправляем сообщения
-    await bot.send_message(
-        chat_id=CHAT_ID, text=contact_info,
-        parse_mode=ParseMode.HTML)
-    await bot.send_message(
-        chat_id=CHAT_ID, text=comments,
-        parse_mode=ParseMode.HTML)
+    # Отправляем сообщения менеджерам в фоне, вне запроса пользователя
+    notifier.notify_lead(contact_info, comments)
 
     # Создаем лид в Битрикс
     await create_bitrix_lead(data, comments)
@@ -825,45 +937,35 @@ async def process_callback(callback_query: CallbackQuery, state: FSMContext):
 
 async def confirm_data(message: Message, state: FSMContext):
     data = await state.get_data()
-    session = Session()
-
-    # Расчеты
-    documents_per_year = calculate_documents_per_year(data)
-    pages_per_year = calculate_pages_per_year(data)
-    total_paper_costs = calculate_total_paper_costs(pages_per_year)
-    total_logistics_costs = calculate_total_logistics_costs(
-        data, documents_per_year)
-    cost_per_minute = calculate_cost_per_minute(data)
-    total_operations_costs = calculate_total_operations_costs(
-        data, documents_per_year, cost_per_minute)
-
-    # Расчет суммы по использованию нашего решения
-    license_costs = session.query(LicenseCosts).first()
-    total_license_costs = calculate_total_license_costs(data, license_costs)
+
+    if 'result' in data:
+        result = CalculationResult.from_dict(data['result'])
+    else:
+        # Анкета сохранена в FSM до появления результата в состоянии
+        result = calculate_costs(data, await get_cost_coefficients())
 
     # Формирование текста сообщения
     user_text1 = (
         "<b>ОСНОВНЫЕ ВЫВОДЫ ПО ВВЕДЕННЫМ ДАННЫМ</b>\n"
         "\n"
         f"<b>Ваши расходы на бумажное КДП: {format_number(
-            total_paper_costs + total_logistics_costs + total_operations_costs
-            )}</b> рублей в год\n"
+            result.current_costs)}</b> рублей в год\n"
         "\n"
         f"Печать и хранение кадровых документов: <b>{format_number(
-            total_paper_costs
+            result.total_paper_costs
             )}</b> рублей в год\n"
         f"Доставка кадровых документов: <b>{format_number(
-            total_logistics_costs
+            result.total_logistics_costs
             )}</b> рублей в год\n"
         "Оплата времени кадрового специалиста, которое "
         f"он тратит на работу с документами: <b>{
-            format_number(total_operations_costs)}</b> рублей в год\n"
+            format_number(result.total_operations_costs)}</b> рублей в год\n"
         "\n"
     )
 
     user_text2 = (
-        f"Внедрив КЭДО от HRlink, вы <b>сможете сэкономить: {format_number(total_paper_costs + total_logistics_costs + total_operations_costs - total_license_costs)}</b> рублей в год.\n"
-        f"<b>Стоимость HRlink для вашей компании:</b> от {format_number(total_license_costs)} рублей в год.\n"
+        f"Внедрив КЭДО от HRlink, вы <b>сможете сэкономить: {format_number(result.savings)}</b> рублей в год.\n"
+        f"<b>Стоимость HRlink для вашей компании:</b> от {format_number(result.total_license_costs)} рублей в год.\n"
         f"<b>Цена лицензии сотрудника:</b> от {data.get('employee_license_cost', 700)} рублей в год.\n"
         "\n"
         "Точная цена рассчитывается менеджером индивидуально для каждого клиента.\n"
@@ -878,16 +980,11 @@ async def confirm_data(message: Message, state: FSMContext):
     )
 
     # Генерация и отправка графика
-    graph_path = generate_cost_graph(
-        total_paper_costs,
-        total_logistics_costs,
-        total_operations_costs,
-        total_license_costs
-        )
-    await message.answer_photo(FSInputFile(graph_path))
-
-    # Удаление временного файла графика
-    os.remove(graph_path)
+    try:
+        await send_cost_graph(message, result)
+    except RenderTimeout:
+        logging.warning("Отрисовка перегружена, график расходов не отправлен")
+        await message.answer(CHART_SKIPPED_TEXT)
 
     # Вывод основных выводов
     await message.answer(user_text1, parse_mode=ParseMode.HTML)
@@ -902,7 +999,27 @@ async def confirm_data(message: Message, state: FSMContext):
     )
 
     await state.clear()  # Очищаем состояние
-    session.close()
+
+
+async def send_cost_graph(message: Message, result: CalculationResult):
+    """
+    Отправляет график по file_id, если он уже загружался в Telegram,
+    иначе загружает PNG и запоминает полученный file_id.
+    """
+    costs = result.as_tuple()
+    chart = await generate_cost_graph(*costs)
+    if chart.file_id:
+        try:
+            await message.answer_photo(chart.file_id)
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Не удалось отправить график по file_id: {e}")
+            chart_cache.forget_file_id(chart.key)
+            chart = await generate_cost_graph(*costs)
+
+    sent = await message.answer_photo(
+        BufferedInputFile(chart.png, filename='cost_graph.png'))
+    chart_cache.set_file_id(chart.key, sent.photo[-1].file_id)
 
 
 async def echo(message: Message):
@@ -917,44 +1034,25 @@ async def echo(message: Message):
 
 
 async def create_bitrix_lead(data, comments):
-    bitrix_webhook_url = (
-        "https://b24.hrlk.ru/rest/7414/d6bo0kujd1cm2owi/crm.lead.add.json"
-    )
-
     # Проверка email
     email = data.get("contact_email", "").strip()
     if not is_valid_email(email):
         email = ""  # Если email невалидный, передаем пустое значение
 
     # Формирование данных для лида
-    lead_data = {
-        "fields": {
-            "TITLE": "Лид с калькулятора в боте",
-            "NAME": data.get("contact_name", "Не указано"),
-            "PHONE": [{"VALUE": data.get("contact_phone", "Не указано"), "VALUE_TYPE": "WORK"}],
-            "EMAIL": [{"VALUE": email, "VALUE_TYPE": "WORK"}] if email else [],  # Передаем email, только если он валидный
-            "COMMENTS": comments,  # Используем комментарии, сформированные из БД
-            "SOURCE_ID": "32",  # Телеграмм-бот / продукт
-            "SOURCE_DESCRIPTION": "Телеграмм-бот / продукт"  # Дополнительно об источнике
-        }
+    lead_fields = {
+        "TITLE": "Лид с калькулятора в боте",
+        "NAME": data.get("contact_name", "Не указано"),
+        "PHONE": [{"VALUE": data.get("contact_phone", "Не указано"), "VALUE_TYPE": "WORK"}],
+        "EMAIL": [{"VALUE": email, "VALUE_TYPE": "WORK"}] if email else [],  # Передаем email, только если он валидный
+        "COMMENTS": comments,  # Используем комментарии, сформированные из БД
+        "SOURCE_ID": "32",  # Телеграмм-бот / продукт
+        "SOURCE_DESCRIPTION": "Телеграмм-бот / продукт"  # Дополнительно об источнике
     }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(bitrix_webhook_url, json=lead_data) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    if response_data.get("result"):
-                        print("Лид успешно создан в Битрикс24")
-                    else:
-                        print(
-                            f"Ошибка при создании лида: {response_data.get('error_description')}"
-                        )
-                else:
-                    print(f"Ошибка HTTP: {response.status}")
-                    print(f"Ответ сервера: {await response.text()}")
-    except Exception as e:
-        print(f"Ошибка при отправке запроса в Битрикс24: {e}")
+    # Лид сохраняется в очередь и отправляется в Битрикс24 в фоне,
+    # поэтому недоступность CRM не задерживает ответ пользователю
+    await enqueue_lead(lead_fields)
 
 
 def format_number(value):
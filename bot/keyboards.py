@@ -32,6 +32,9 @@ def get_contact_keyboard():
         [InlineKeyboardButton(
             text="Оставить заявку 🙋‍♂️🙋‍♀️", callback_data="contact_me"
             )],
+        [InlineKeyboardButton(
+            text="Сравнить все тарифы 📊", callback_data="compare_tariffs"
+            )],
         [InlineKeyboardButton(
             text="Расчитать другой тариф ⚙",
             callback_data="restart")]
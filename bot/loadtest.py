@@ -0,0 +1,246 @@
+"""
+Нагрузочный тест обработчиков без обращения к Telegram.
+
+Виртуальные пользователи проходят всю анкету (от /start до заявки)
+через Dispatcher.feed_update, а запросы к Bot API подменяются заглушкой.
+Данные пишутся во временную БД, рабочая user_data.db не затрагивается.
+
+Запуск из папки bot:
+    python loadtest.py --users 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+# Временная БД должна быть задана до импорта модулей бота
+_tmp_dir = tempfile.mkdtemp(prefix='loadtest-')
+os.environ['DATABASE_URL'] = (
+    f"sqlite:///{os.path.join(_tmp_dir, 'loadtest.db')}")
+
+from aiogram import Bot, Dispatcher, BaseMiddleware  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.methods import SendMessage, SendPhoto  # noqa: E402
+from aiogram.types import (  # noqa: E402
+    Update, Message, CallbackQuery, User, Chat, PhotoSize
+)
+import handlers  # noqa: E402
+from coefficients import reload_cost_coefficients  # noqa: E402
+from database import init_db  # noqa: E402
+from graph import shutdown_render_pool  # noqa: E402
+from storage import SQLiteStorage  # noqa: E402
+
+FAKE_TOKEN = '123456:LOADTEST-LOADTEST-LOADTEST-LOADTEST'
+# ID виртуальных пользователей начинаются отсюда
+BASE_USER_ID = 10 ** 12
+
+_ids = itertools.count(1)
+
+
+class FakeSession(BaseSession):
+    """
+    Заглушка Bot API: отвечает на запросы без сети с задержкой latency.
+    """
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = defaultdict(int)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, SendPhoto)):
+            photo = None
+            if isinstance(method, SendPhoto):
+                photo = [PhotoSize(
+                    file_id=f'photo-{next(_ids)}', file_unique_id='loadtest',
+                    width=1000, height=600)]
+            return Message(
+                message_id=next(_ids), date=datetime.now(),
+                chat=Chat(id=int(method.chat_id), type='private'),
+                photo=photo)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class HandlerTimer(BaseMiddleware):
+    """
+    Замеряет время работы каждого обработчика.
+    """
+    def __init__(self, samples):
+        self.samples = samples
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = data['handler'].callback.__name__
+            self.samples[name].append(time.perf_counter() - started)
+
+
+def _user(user_id):
+    return User(
+        id=user_id, is_bot=False, first_name='Load',
+        username=f'load{user_id}')
+
+
+def _message(user_id, text):
+    return Update(update_id=next(_ids), message=Message(
+        message_id=next(_ids), date=datetime.now(),
+        chat=Chat(id=user_id, type='private'),
+        from_user=_user(user_id), text=text))
+
+
+def _callback(user_id, data):
+    message = Message(
+        message_id=next(_ids), date=datetime.now(),
+        chat=Chat(id=user_id, type='private'), text='-')
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(
+        id=str(next(_ids)), from_user=_user(user_id), chat_instance='load',
+        message=message, data=data))
+
+
+def questionnaire(user_id, rng):
+    """
+    Шаги анкеты виртуального пользователя: (название шага, Update).
+    """
+    employee_count = rng.randint(10, 3000)
+    courier_delivery_cost = rng.choice([0, 300, 500, 900])
+    steps = [
+        ('start', _message(user_id, '/start')),
+        ('start_form', _callback(user_id, 'start_form')),
+        ('employee_count', _message(user_id, str(employee_count))),
+    ]
+    if employee_count < 500:
+        steps.append(('license_type', _callback(
+            user_id, rng.choice(['simple_kedo', 'standard_kedo']))))
+    steps += [
+        ('hr_specialist_count', _message(user_id, str(rng.randint(1, 20)))),
+        ('documents_per_employee', _message(
+            user_id, str(rng.randint(10, 60)))),
+        ('pages_per_document', _message(
+            user_id, f'{rng.uniform(1, 3):.1f}'.replace('.', ','))),
+        ('turnover_percentage', _message(user_id, str(rng.randint(0, 40)))),
+        ('average_salary', _message(
+            user_id, str(rng.randint(40, 200) * 1000))),
+        ('courier_delivery_cost', _message(
+            user_id, str(courier_delivery_cost))),
+    ]
+    if courier_delivery_cost > 0:
+        steps.append(('hr_delivery_percentage', _message(
+            user_id, str(rng.randint(5, 50)))))
+    steps += [
+        ('confirm', _callback(user_id, 'confirm')),
+        ('contact_me', _callback(user_id, 'contact_me')),
+        ('contact_name', _message(user_id, 'Иван')),
+        ('contact_phone', _message(user_id, '+79990000000')),
+        ('contact_email', _message(user_id, 'load@example.com')),
+        ('organization_name', _message(user_id, 'ООО Нагрузка')),
+    ]
+    return steps
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, int(round(percent / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def format_table(title, samples):
+    lines = [
+        title,
+        f"{'':<34}{'count':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}",
+    ]
+    for name, values in samples.items():
+        lines.append(
+            f"{name:<34}{len(values):>7}"
+            f"{percentile(values, 50) * 1000:>10.2f}"
+            f"{percentile(values, 95) * 1000:>10.2f}"
+            f"{percentile(values, 99) * 1000:>10.2f}")
+    return '\n'.join(lines)
+
+
+async def run(users, concurrency, storage_name, api_latency, seed):
+    init_db()
+    await reload_cost_coefficients()
+
+    session = FakeSession(api_latency)
+    bot = Bot(token=FAKE_TOKEN, session=session)
+    # Уведомления менеджерам отправляются глобальным ботом из handlers
+    handlers.bot.session = session
+
+    storage = SQLiteStorage() if storage_name == 'sqlite' else MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    handlers.register_handlers(dp)
+
+    handler_samples = defaultdict(list)
+    step_samples = defaultdict(list)
+    timer = HandlerTimer(handler_samples)
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+
+    rng = random.Random(seed)
+    flows = [
+        questionnaire(BASE_USER_ID + index, rng) for index in range(users)
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def walk(steps):
+        async with semaphore:
+            for step, update in steps:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                step_samples[step].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(walk(steps) for steps in flows))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(steps) for steps in flows)
+
+    await dp.emit_shutdown(bot=bot)
+    shutdown_render_pool()
+
+    print(f"Пользователей: {users}, одновременно: {concurrency}, "
+          f"FSM: {storage_name}, задержка API: {api_latency * 1000:.0f} мс")
+    print(f"Время: {elapsed:.2f} с, анкет в секунду: {users / elapsed:.1f}, "
+          f"обновлений в секунду: {updates / elapsed:.1f}")
+    print()
+    print(format_table('По шагам анкеты', step_samples))
+    print()
+    print(format_table('По обработчикам', handler_samples))
+    print()
+    print('Запросы к Bot API: ' + ', '.join(
+        f"{name} {count}" for name, count in sorted(session.requests.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument(
+        '--storage', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument(
+        '--api-latency', type=float, default=0.0,
+        help='Задержка ответа Bot API в миллисекундах')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(
+        args.users, args.concurrency, args.storage,
+        args.api_latency / 1000, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError
+from decouple import Config, RepositoryEnv
+
+config = Config(RepositoryEnv('.env'))
+# Адрес HTTP-сервера с метриками, /health и /ready; порт 0 - не запускать
+METRICS_HOST = config('METRICS_HOST', default='127.0.0.1')
+METRICS_PORT = config('METRICS_PORT', default=9100, cast=int)
+# Сколько секунд ждать ответа БД при проверке готовности
+READY_TIMEOUT = 2.0
+
+# Границы корзин гистограмм задержек (в секундах)
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Расчеты занимают микросекунды, поэтому для них корзины мельче
+FAST_BUCKETS = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for key, value in list(self._values.items()):
+            yield from self._samples(key, value)
+
+    def _samples(self, key, value):
+        labels = _format_labels(self.labelnames, key)
+        yield f'{self.name}{labels} {value}'
+
+
+class Counter(_Metric):
+    """
+    Монотонно растущий счетчик.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение; с function значение читается при каждом сборе.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self):
+        if self.function is not None:
+            self._values[()] = self.function()
+        return super().collect()
+
+
+class Histogram(_Metric):
+    """
+    Распределение значений по корзинам, с суммой и числом наблюдений.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Счетчики по корзинам (последняя - +Inf) и сумма значений
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def _samples(self, key, state):
+        counts, total = state
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ('le', bound))
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.labelnames, key)
+        yield f'{self.name}_sum{labels} {total}'
+        yield f'{self.name}_count{labels} {cumulative}'
+
+
+def timed(histogram, **labels):
+    """
+    Декоратор: записывает в histogram время выполнения функции
+    (обычной или асинхронной).
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(
+                        time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """
+    Все метрики процесса в текстовом формате Prometheus.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+# Обработка обновлений
+UPDATES = Counter(
+    'bot_updates_total', 'Полученные обновления', ['type'])
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds', 'Время работы обработчиков', ['handler'])
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках',
+    ['handler', 'error'])
+
+# База данных и расчеты
+DB_SECONDS = Histogram(
+    'bot_db_seconds', 'Время запросов к БД в пуле потоков', ['query'])
+CALCULATION_SECONDS = Histogram(
+    'bot_calculation_seconds', 'Время шагов расчета', ['step'],
+    buckets=FAST_BUCKETS)
+
+# Графики
+CHART_REQUESTS = Counter(
+    'bot_chart_requests_total',
+    'Запросы графиков: cache - из кэша, shared - ожидание уже идущей '
+    'отрисовки, rendered - новая отрисовка, timeout - не дождался '
+    'свободного процесса отрисовки, rejected - очередь ожидания заполнена',
+    ['result'])
+CHART_RENDER_SECONDS = Histogram(
+    'bot_chart_render_seconds', 'Время отрисовки графика с ожиданием пула')
+
+# Telegram Bot API
+TELEGRAM_SECONDS = Histogram(
+    'bot_telegram_request_seconds', 'Время запросов к Bot API', ['method'])
+TELEGRAM_ERRORS = Counter(
+    'bot_telegram_errors_total', 'Ошибки запросов к Bot API',
+    ['method', 'error'])
+BROADCAST_MESSAGES = Counter(
+    'bot_broadcast_messages_total', 'Сообщения рассылки по результату',
+    ['status'])
+
+# Битрикс24
+CRM_LEADS = Counter(
+    'bot_crm_leads_total',
+    'Лиды: enqueued - поставлен в очередь, sent - создан, '
+    'failed - неудачная попытка', ['result'])
+CRM_REQUEST_SECONDS = Histogram(
+    'bot_crm_request_seconds', 'Время запросов к Битрикс24', ['method'])
+CRM_REQUEST_ERRORS = Counter(
+    'bot_crm_request_errors_total', 'Неудачные запросы к Битрикс24',
+    ['method'])
+
+STARTED_AT = time.time()
+UPTIME = Gauge(
+    'bot_uptime_seconds', 'Время работы процесса',
+    function=lambda: round(time.time() - STARTED_AT, 3))
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для dp.update: считает обновления по типам.
+    """
+    async def __call__(self, handler, event, data):
+        UPDATES.inc(type=event.event_type)
+        return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: время и ошибки каждого обработчика.
+    """
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(
+                time.perf_counter() - started, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: время и ошибки всех запросов к Bot API.
+    """
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(
+                time.perf_counter() - started, method=name)
+
+
+def setup_metrics(dispatcher):
+    """
+    Подключает сбор метрик обработки обновлений к диспетчеру.
+    """
+    dispatcher.update.outer_middleware(UpdateMetricsMiddleware())
+    middleware = HandlerMetricsMiddleware()
+    for observer in dispatcher.observers.values():
+        if observer.event_name != 'update':
+            observer.middleware(middleware)
+    dispatcher.startup.register(_mark_ready)
+    dispatcher.shutdown.register(_mark_not_ready)
+
+
+def instrument_bot(bot: Bot):
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+_ready = False
+
+
+async def _mark_ready():
+    global _ready
+    _ready = True
+
+
+async def _mark_not_ready():
+    global _ready
+    _ready = False
+
+
+async def check_ready():
+    """
+    :return: словарь проверок; процесс готов, если все они True
+    """
+    from database import run_db, ping
+
+    checks = {'dispatcher': _ready}
+    try:
+        await asyncio.wait_for(run_db(ping), timeout=READY_TIMEOUT)
+        checks['database'] = True
+    except Exception as e:
+        logging.warning(f"БД не отвечает при проверке готовности: {e}")
+        checks['database'] = False
+    return checks
+
+
+async def handle_metrics(request):
+    return web.Response(
+        text=render_metrics(), content_type='text/plain', charset='utf-8',
+        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def handle_health(request):
+    # Ответ означает, что event loop процесса не заблокирован
+    return web.json_response({'status': 'ok'})
+
+
+async def handle_ready(request):
+    checks = await check_ready()
+    ready = all(checks.values())
+    return web.json_response(
+        {'status': 'ready' if ready else 'not ready', 'checks': checks},
+        status=200 if ready else 503)
+
+
+def add_metrics_routes(app: web.Application):
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/ready', handle_ready)
+
+
+class MetricsServer:
+    """
+    Локальный HTTP-сервер с /metrics, /health и /ready.
+    """
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        add_metrics_routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Метрики доступны на {self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
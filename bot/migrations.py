@@ -0,0 +1,63 @@
+"""
+Минимальные миграции схемы для существующих баз SQLite.
+
+Номер последней примененной миграции хранится в PRAGMA user_version.
+Новые таблицы и индексы на чистой базе создает Base.metadata.create_all,
+поэтому каждая миграция должна быть идемпотентной (IF NOT EXISTS и т.п.).
+Новые миграции добавляются только в конец списка MIGRATIONS.
+"""
+import logging
+
+
+def add_user_data_indexes(connection):
+    # Индекс не уникальный: в существующих базах у пользователя бывает
+    # несколько анкет, и миграция схемы не должна удалять данные
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_user_data_user_id "
+        "ON user_data (user_id)")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_user_data_timestamp "
+        "ON user_data (timestamp)")
+
+
+def keep_user_data_history(connection):
+    # Анкеты больше не перезаписываются, а последняя запись
+    # пользователя ищется через user_latest
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user_latest (
+            user_id INTEGER NOT NULL PRIMARY KEY,
+            user_data_id INTEGER NOT NULL REFERENCES user_data (id)
+        )
+    """)
+    # Раньше анкета могла перезаписываться на месте, поэтому самая
+    # свежая выбирается по времени, а не по id
+    connection.exec_driver_sql("""
+        INSERT OR REPLACE INTO user_latest (user_id, user_data_id)
+        SELECT user_id, id FROM (
+            SELECT user_id, id, ROW_NUMBER() OVER (
+                PARTITION BY user_id ORDER BY timestamp DESC, id DESC
+            ) AS row_number
+            FROM user_data
+            WHERE user_id IS NOT NULL
+        ) WHERE row_number = 1
+    """)
+
+
+MIGRATIONS = [
+    add_user_data_indexes,
+    keep_user_data_history,
+]
+
+
+def run_migrations(engine):
+    """
+    Применяет к базе все миграции, которые еще не были применены.
+    """
+    with engine.begin() as connection:
+        version = connection.exec_driver_sql(
+            'PRAGMA user_version').scalar()
+        for number in range(version, len(MIGRATIONS)):
+            migration = MIGRATIONS[number]
+            migration(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {number + 1}')
+            logging.info(f"Применена миграция {number + 1}: {migration.__name__}")
@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy import (
+    Column, Integer, Float, String, DateTime, Date, Text, ForeignKey,
+    LargeBinary
+)
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -9,7 +12,8 @@ class UserData(Base):
     __tablename__ = 'user_data'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=False)
+    # Анкеты пользователя хранятся как история: одна запись на расчет
+    user_id = Column(Integer, index=True)
     organization_name = Column(String)
     employee_count = Column(Integer)
     hr_specialist_count = Column(Integer)
@@ -24,13 +28,24 @@ class UserData(Base):
     tariff_name = Column(String)  # Название тарифа (HRlink Lite, HRlink Standard, HRlink Enterprise)
     license_type = Column(String)  # Тип лицензии
     employee_license_cost = Column(Float)  # Добавьте это поле
-    timestamp = Column(DateTime, default=datetime.now())
+    timestamp = Column(DateTime, default=datetime.now(), index=True)
     total_paper_costs = Column(Float)
     total_logistics_costs = Column(Float)
     total_operations_costs = Column(Float)
     total_license_costs = Column(Float)
 
 
+class UserLatest(Base):
+    """
+    Указатель на последнюю запись user_data каждого пользователя.
+    """
+    __tablename__ = 'user_latest'
+
+    user_id = Column(Integer, primary_key=True)
+    user_data_id = Column(
+        Integer, ForeignKey('user_data.id'), nullable=False)
+
+
 class PaperCosts(Base):
     __tablename__ = 'paper_costs'
 
@@ -56,3 +71,64 @@ class TypicalOperations(Base):
     time_of_printing = Column(Integer, default=2)
     time_of_signing = Column(Integer, default=4)
     tome_of_archiving = Column(Integer, default=2)
+
+
+class DailyUsers(Base):
+    """
+    Уникальные пользователи за день: отсортированный массив user_id
+    (array('q') в байтах) и их количество.
+    """
+    __tablename__ = 'daily_users'
+
+    day = Column(Date, primary_key=True)
+    user_ids = Column(LargeBinary, nullable=False)
+    users_count = Column(Integer, nullable=False)
+
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    id = Column(Integer, primary_key=True)
+    text = Column(Text)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)  # NULL, пока рассылка не завершена
+
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+
+    broadcast_id = Column(
+        Integer, ForeignKey('broadcasts.id'), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    status = Column(String)  # sent, failed, retry
+    error = Column(String)
+
+
+class FsmState(Base):
+    """
+    Сохраненное состояние анкеты (FSM) пользователя.
+    """
+    __tablename__ = 'fsm_states'
+
+    key = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(Text)  # JSON
+    updated_at = Column(DateTime, index=True)
+
+
+class CrmOutbox(Base):
+    """
+    Очередь лидов для отправки в Битрикс24.
+    """
+    __tablename__ = 'crm_outbox'
+
+    id = Column(Integer, primary_key=True)
+    payload = Column(Text, nullable=False)  # JSON с полями лида
+    # pending, sent, failed
+    status = Column(String, default='pending', index=True)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.now)
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime)
+    lead_id = Column(Integer)
+    last_error = Column(Text)
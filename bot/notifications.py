@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import logging
+import time
+from datetime import datetime
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
+from decouple import Config, RepositoryEnv
+
+config = Config(RepositoryEnv('.env'))
+# Если за интервал новых пользователей больше порога, остальные
+# уведомления объединяются в одну сводку в конце интервала
+NEW_USERS_DIGEST_THRESHOLD = config(
+    'NEW_USERS_DIGEST_THRESHOLD', default=5, cast=int)
+NEW_USERS_DIGEST_INTERVAL = config(
+    'NEW_USERS_DIGEST_INTERVAL', default=60, cast=int)
+# Пауза между сообщениями в чат менеджеров: в группу Telegram
+# разрешает около 20 сообщений в минуту
+CHAT_SEND_INTERVAL = 3.0
+# Сколько секунд при остановке бота ждать отправки оставшихся сообщений
+NOTIFY_DRAIN_TIMEOUT = 30
+# Сколько пользователей перечислять в сводке
+DIGEST_MAX_USERS = 30
+
+PRIORITY_LEAD = 0
+PRIORITY_NEW_USER = 1
+
+
+class NotificationDispatcher:
+    """
+    Очередь уведомлений для чата менеджеров. Сообщения отправляются
+    в фоне, заявки - в первую очередь, а при наплыве новых пользователей
+    уведомления о них объединяются в сводки.
+
+    Пауза send_interval между сообщениями соблюдается внутри одного
+    процесса. В режиме cluster у каждого воркера свой диспетчер, поэтому
+    интервал увеличивается на число воркеров (см. bot.create_dispatcher).
+    """
+    def __init__(self, bot: Bot, chat_id, send_interval=CHAT_SEND_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.send_interval = send_interval
+        self._last_sent_at = None
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._window_started = 0.0
+        self._window_count = 0
+        self._digest = []
+        self._tasks = []
+
+    def _start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._send_loop()),
+                asyncio.create_task(self._digest_loop()),
+            ]
+
+    def _put(self, priority, text):
+        self._start()
+        self._queue.put_nowait((priority, next(self._order), text))
+
+    def notify_lead(self, *texts):
+        """
+        Ставит сообщения о заявке в очередь с наивысшим приоритетом.
+        """
+        for text in texts:
+            self._put(PRIORITY_LEAD, text)
+
+    def notify_new_user(self, user_id, username):
+        now = time.monotonic()
+        if now - self._window_started > NEW_USERS_DIGEST_INTERVAL:
+            self._window_started = now
+            self._window_count = 0
+        self._window_count += 1
+
+        if self._window_count <= NEW_USERS_DIGEST_THRESHOLD:
+            self._put(PRIORITY_NEW_USER, (
+                "🚀 <b>Новый пользователь!</b>\n"
+                f"<b>ID:</b> {user_id}\n"
+                f"<b>Имя пользователя:</b> @{username}\n"
+                f"<b>Время:</b> "
+                f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            ))
+        else:
+            self._start()
+            self._digest.append((user_id, username))
+
+    def _flush_digest(self):
+        users, self._digest = self._digest, []
+        if not users:
+            return
+        lines = [
+            f"{user_id} — @{username}"
+            for user_id, username in users[:DIGEST_MAX_USERS]
+        ]
+        if len(users) > DIGEST_MAX_USERS:
+            lines.append(f"и еще {len(users) - DIGEST_MAX_USERS}")
+        self._put(PRIORITY_NEW_USER, (
+            f"🚀 <b>Новые пользователи: {len(users)}</b>\n"
+            + "\n".join(lines)
+        ))
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(NEW_USERS_DIGEST_INTERVAL)
+            self._flush_digest()
+
+    async def _send(self, text):
+        while True:
+            try:
+                await self.bot.send_message(
+                    chat_id=self.chat_id, text=text,
+                    parse_mode=ParseMode.HTML)
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке уведомления: {e}")
+                return
+
+    async def _send_loop(self):
+        while True:
+            priority, _, text = await self._queue.get()
+            if self._last_sent_at is not None:
+                delay = (self._last_sent_at + self.send_interval
+                         - time.monotonic())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self._send(text)
+            self._last_sent_at = time.monotonic()
+            self._queue.task_done()
+
+    async def stop(self):
+        """
+        Отправляет накопленное (сводку и очередь) с той же паузой между
+        сообщениями, но не дольше NOTIFY_DRAIN_TIMEOUT, и останавливает
+        задачи.
+        """
+        if not self._tasks:
+            return
+        send_task, digest_task = self._tasks
+        digest_task.cancel()
+        self._flush_digest()
+        try:
+            await asyncio.wait_for(
+                self._queue.join(), timeout=NOTIFY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Уведомления при остановке отправлены не все, "
+                f"в очереди осталось: {self._queue.qsize()}")
+        send_task.cancel()
+        self._tasks = []
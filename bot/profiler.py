@@ -0,0 +1,189 @@
+"""
+Профилирование работающего бота по команде администратора.
+
+Пока профилирование не запущено, ничего не собирается: поток-сэмплер
+и tracemalloc включаются только на время снимка.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Как часто снимать стеки потоков (в секундах)
+PROFILE_INTERVAL = 0.005
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+# Сколько строк выводить в отчетах
+TOP_FUNCTIONS = 20
+TOP_ALLOCATIONS = 30
+# Глубина стека, сохраняемая tracemalloc для каждого выделения памяти
+TRACEMALLOC_FRAMES = 5
+
+_lock = asyncio.Lock()
+
+
+class ProfileBusy(Exception):
+    """
+    Профилирование уже идет.
+    """
+
+
+class ProfileResult:
+    """
+    Результат снимка: отчеты в виде байтов, готовые к отправке файлами.
+    """
+    __slots__ = ('cpu_report', 'collapsed_stacks', 'memory_report', 'samples')
+
+    def __init__(self, cpu_report, collapsed_stacks, memory_report, samples):
+        self.cpu_report = cpu_report
+        self.collapsed_stacks = collapsed_stacks
+        self.memory_report = memory_report
+        self.samples = samples
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return (f"{code.co_qualname} "
+            f"({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Поток, который периодически снимает стеки всех остальных потоков
+    процесса: event loop, пула БД и служебных потоков.
+    """
+    def __init__(self, duration, interval=PROFILE_INTERVAL):
+        super().__init__(name='profiler', daemon=True)
+        self.duration = duration
+        self.interval = interval
+        # Стек (от корня к листу) -> число попаданий
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """
+        Стеки в формате collapsed (для flamegraph.pl и speedscope).
+        """
+        return '\n'.join(
+            f"{';'.join(stack)} {count}"
+            for stack, count in self.stacks.most_common())
+
+    def report(self):
+        # Статистика считается по каждому потоку отдельно: проценты -
+        # доля снимков потока, в которых функция была в его стеке
+        threads = {}
+        for stack, count in self.stacks.items():
+            samples, own, total = threads.setdefault(
+                stack[0], [0, Counter(), Counter()])
+            threads[stack[0]][0] = samples + count
+            own[stack[-1]] += count
+            # Функция, вызванная рекурсивно, учитывается один раз
+            for name in set(stack[1:]):
+                total[name] += count
+
+        lines = [
+            f"Снимков: {self.samples}, интервал {self.interval * 1000:.0f} мс",
+            "Процессы отрисовки графиков не профилируются, в потоке event "
+            "loop ожидание отрисовки видно как select/epoll.",
+        ]
+        ordered = sorted(
+            threads.items(), key=lambda item: (
+                item[0] != 'MainThread', -item[1][0]))
+        for thread_name, (samples, own, total) in ordered:
+            for title, counter in (
+                    ("собственное время (функция на вершине стека)", own),
+                    ("общее время (функция где-либо в стеке)", total)):
+                lines += ["", f"Поток {thread_name}, {title}:"]
+                lines += [
+                    f"  {count:>7}  {count / samples * 100:6.1f}%  {name}"
+                    for name, count in counter.most_common(TOP_FUNCTIONS)
+                ]
+        return '\n'.join(lines)
+
+
+def _memory_report(snapshot, started_tracing):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    statistics = snapshot.statistics('lineno')
+    total = sum(stat.size for stat in statistics)
+    lines = [
+        f"Отслеживается памяти: {total / 1024:.1f} КиБ",
+    ]
+    if started_tracing:
+        lines.append(
+            "tracemalloc был включен только на время снимка, поэтому "
+            "учтены лишь выделения, сделанные за это время и не "
+            "освобожденные к его концу.")
+    lines += ["", f"Топ-{TOP_ALLOCATIONS} мест выделения памяти:"]
+    for index, stat in enumerate(statistics[:TOP_ALLOCATIONS], 1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"{index:>3}. {stat.size / 1024:10.1f} КиБ  {stat.count:>7} "
+            f"блоков  {frame.filename}:{frame.lineno}")
+
+    lines += ["", "Стеки крупнейших мест выделения:"]
+    for stat in snapshot.statistics('traceback')[:5]:
+        lines.append(f"{stat.size / 1024:.1f} КиБ, {stat.count} блоков:")
+        lines += [f"    {line}" for line in stat.traceback.format()]
+    return '\n'.join(lines)
+
+
+async def capture_profile(seconds=PROFILE_DEFAULT_SECONDS):
+    """
+    Снимает профиль CPU и распределение памяти за seconds секунд,
+    не блокируя event loop.
+
+    :raises ProfileBusy: если профилирование уже идет
+    """
+    if _lock.locked():
+        raise ProfileBusy()
+    async with _lock:
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        profiler = SamplingProfiler(seconds)
+        try:
+            profiler.start()
+            await asyncio.sleep(seconds)
+            await asyncio.to_thread(profiler.join)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            # Если tracemalloc включили не мы (PYTHONTRACEMALLOC),
+            # оставляем его работать
+            if started_tracing:
+                tracemalloc.stop()
+
+        memory_report = await asyncio.to_thread(
+            _memory_report, snapshot, started_tracing)
+        return ProfileResult(
+            cpu_report=profiler.report().encode(),
+            collapsed_stacks=profiler.collapsed().encode(),
+            memory_report=memory_report.encode(),
+            samples=profiler.samples)
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+)
+from sqlalchemy.dialects.sqlite import insert
+from database import Session, run_db
+from models import FsmState
+
+# Как часто накопленные изменения записываются в БД (в секундах)
+FSM_FLUSH_INTERVAL = 1.0
+# Через сколько секунд без активности состояние выгружается из памяти
+FSM_CACHE_IDLE = 10 * 60
+# Через сколько секунд без активности анкета удаляется совсем
+FSM_STATE_TTL = 24 * 60 * 60
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'dirty', 'touched_at')
+
+    def __init__(self, state=None, data=None):
+        self.state = state
+        self.data = data or {}
+        self.dirty = False
+        self.touched_at = time.monotonic()
+
+
+def _load_record(key, ttl):
+    with Session() as session:
+        row = session.get(FsmState, key)
+        expired = datetime.now() - timedelta(seconds=ttl)
+        if row is None or row.updated_at < expired:
+            return _Record()
+        return _Record(row.state, json.loads(row.data) if row.data else {})
+
+
+def _write_records(changes, expire_before):
+    """
+    Записывает все измененные состояния одной транзакцией и удаляет
+    анкеты, которые не обновлялись дольше FSM_STATE_TTL.
+    """
+    now = datetime.now()
+    with Session() as session:
+        for key, state, data in changes:
+            if state is None and not data:
+                session.query(FsmState).filter_by(key=key).delete()
+                continue
+            values = {
+                'state': state,
+                'data': json.dumps(data, ensure_ascii=False, default=str),
+                'updated_at': now,
+            }
+            session.execute(
+                insert(FsmState).values(key=key, **values)
+                .on_conflict_do_update(index_elements=['key'], set_=values))
+        if expire_before is not None:
+            session.query(FsmState).filter(
+                FsmState.updated_at < expire_before).delete()
+        session.commit()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite с кэшем в памяти.
+
+    Чтения обслуживаются из кэша, а изменения копятся в нем и раз в
+    flush_interval секунд записываются в БД одной транзакцией, поэтому
+    несколько update_data за один шаг анкеты дают одну запись.
+    Анкеты без активности дольше ttl секунд удаляются.
+    """
+    def __init__(
+            self, flush_interval=FSM_FLUSH_INTERVAL,
+            cache_idle=FSM_CACHE_IDLE, ttl=FSM_STATE_TTL):
+        self.flush_interval = flush_interval
+        self.cache_idle = cache_idle
+        self.ttl = ttl
+        self._key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._cache = {}
+        self._flush_task = None
+        self._last_expire = 0.0
+
+    async def _get_record(self, key: StorageKey):
+        storage_key = self._key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            loaded = await run_db(_load_record, storage_key, self.ttl)
+            # Пока шла загрузка, запись могла появиться в кэше
+            record = self._cache.setdefault(storage_key, loaded)
+        if time.monotonic() - record.touched_at > self.ttl:
+            record.state = None
+            record.data = {}
+            record.dirty = True
+        record.touched_at = time.monotonic()
+        return record
+
+    def _mark_dirty(self, record):
+        record.dirty = True
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(record)
+
+    async def get_state(self, key: StorageKey):
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data):
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(record)
+
+    async def get_data(self, key: StorageKey):
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения и выгружает неактивные состояния.
+        """
+        now = time.monotonic()
+        changes = []
+        flushed = []
+        for storage_key, record in list(self._cache.items()):
+            if record.dirty:
+                changes.append((storage_key, record.state, record.data.copy()))
+                flushed.append(record)
+                # Флаг снимается до записи, чтобы изменения, сделанные
+                # во время нее, попали в следующую запись
+                record.dirty = False
+            elif now - record.touched_at > self.cache_idle:
+                del self._cache[storage_key]
+
+        expire_before = None
+        if now - self._last_expire > self.cache_idle:
+            expire_before = datetime.now() - timedelta(seconds=self.ttl)
+            self._last_expire = now
+
+        if changes or expire_before is not None:
+            try:
+                await run_db(_write_records, changes, expire_before)
+            except BaseException:
+                # Запись не удалась: состояния остаются измененными
+                # и будут записаны при следующей попытке
+                for record in flushed:
+                    record.dirty = True
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении состояний FSM: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,136 @@
+"""
+Защита от флуда и сброс нагрузки до того, как обновление дойдет до
+обработчиков с обращениями к БД и отрисовкой графиков.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from decouple import Config, RepositoryEnv
+from filters import ADMIN_IDS
+from metrics import Counter, Gauge
+
+config = Config(RepositoryEnv('.env'))
+# Сколько обновлений в секунду в среднем разрешено одному пользователю
+# и сколько подряд он может прислать сверх этого
+THROTTLE_RATE = config('THROTTLE_RATE', default=1.0, cast=float)
+THROTTLE_BURST = config('THROTTLE_BURST', default=8, cast=int)
+# Сколько обновлений обрабатывается одновременно во всем процессе,
+# сколько может ждать очереди и как долго (в секундах)
+MAX_CONCURRENT_UPDATES = config(
+    'MAX_CONCURRENT_UPDATES', default=64, cast=int)
+MAX_WAITING_UPDATES = config('MAX_WAITING_UPDATES', default=256, cast=int)
+UPDATE_WAIT_TIMEOUT = config('UPDATE_WAIT_TIMEOUT', default=5.0, cast=float)
+# Сколько пользователей помнить одновременно
+THROTTLE_MAX_USERS = 100_000
+
+THROTTLED = Counter(
+    'bot_throttled_updates_total',
+    'Отброшенные обновления: rate - пользователь превысил лимит, '
+    'overload - процесс перегружен', ['reason'])
+IN_PROGRESS = Gauge('bot_updates_in_progress', 'Обновления в обработке')
+WAITING = Gauge('bot_updates_waiting', 'Обновления в очереди на обработку')
+
+
+class TokenBuckets:
+    """
+    Token bucket для каждого пользователя в виде GCRA: на пользователя
+    хранится одно число - момент, когда его корзина снова станет полной.
+    Пользователи с полной корзиной ничем не отличаются от новых, поэтому
+    вытесняются без потери информации.
+    """
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST,
+                 max_size=THROTTLE_MAX_USERS):
+        self.interval = 1 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.max_size = max_size
+        # user_id -> момент заполнения корзины, от давно активных к недавним
+        self._full_at = OrderedDict()
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def allow(self, key, now=None):
+        """
+        Списывает одно обновление из корзины пользователя.
+
+        :return: False, если корзина пуста
+        """
+        if now is None:
+            now = time.monotonic()
+        full_at = max(self._full_at.get(key, now), now)
+        if full_at - now > self.tolerance:
+            return False
+        self._full_at[key] = full_at + self.interval
+        self._full_at.move_to_end(key)
+        self._evict(now)
+        return True
+
+    def _evict(self, now):
+        items = self._full_at
+        while items:
+            key, full_at = next(iter(items.items()))
+            # Самые давние пользователи в начале: убираем тех, чья корзина
+            # уже полна, и сверх лимита - в любом случае
+            if full_at > now and len(items) <= self.max_size:
+                break
+            del items[key]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для dp.update: отбрасывает обновления
+    пользователей, превысивших лимит, и ограничивает число одновременно
+    обрабатываемых обновлений. Лишние обновления ждут свободного места
+    не дольше UPDATE_WAIT_TIMEOUT, а при переполненной очереди
+    отбрасываются сразу.
+    """
+    def __init__(self, buckets=None,
+                 max_concurrent=MAX_CONCURRENT_UPDATES,
+                 max_waiting=MAX_WAITING_UPDATES,
+                 wait_timeout=UPDATE_WAIT_TIMEOUT):
+        self.buckets = buckets or TokenBuckets()
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._waiting = 0
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if (user is not None and user.id not in ADMIN_IDS
+                and not self.buckets.allow(user.id)):
+            THROTTLED.inc(reason='rate')
+            logging.debug(f"Флуд от пользователя {user.id}, обновление "
+                          f"{event.update_id} отброшено")
+            return None
+
+        if not await self._acquire():
+            THROTTLED.inc(reason='overload')
+            logging.warning(
+                f"Бот перегружен, обновление {event.update_id} отброшено")
+            return None
+        IN_PROGRESS.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            IN_PROGRESS.dec()
+            self._slots.release()
+
+    async def _acquire(self):
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return True
+        if self._waiting >= self.max_waiting:
+            return False
+        self._waiting += 1
+        WAITING.inc()
+        try:
+            await asyncio.wait_for(
+                self._slots.acquire(), timeout=self.wait_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting -= 1
+            WAITING.dec()
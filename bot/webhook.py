@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import secrets
+from collections import deque
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+# Сколько последних update_id помнить для отсева повторных доставок
+SEEN_UPDATES_SIZE = 10000
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class RecentUpdates:
+    """
+    Ограниченный набор последних update_id.
+    """
+    def __init__(self, size=SEEN_UPDATES_SIZE):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+
+    def add(self, update_id):
+        """
+        :return: False, если такой update_id уже встречался
+        """
+        if update_id in self._ids:
+            return False
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+class WebhookHandler:
+    """
+    Принимает обновления от Telegram: проверяет секретный токен, отсеивает
+    повторные доставки и сразу отвечает 200, а обработка идет в фоне.
+    """
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret_token = secret_token
+        self.recent = RecentUpdates()
+        self._tasks = set()
+
+    async def handle(self, request: web.Request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not secrets.compare_digest(token, self.secret_token):
+            return web.Response(status=401)
+
+        update = Update.model_validate(
+            await request.json(), context={'bot': self.bot})
+        if self.recent.add(update.update_id):
+            self.feed(update)
+        return web.Response()
+
+    def feed(self, update: Update):
+        task = asyncio.create_task(self._process(update))
+        # Держим ссылки на задачи, чтобы их не собрал сборщик мусора
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, update: Update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке обновления "
+                          f"{update.update_id}: {e}")
+
+    async def wait_closed(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def serve_app(app: web.Application, host, port):
+    """
+    Запускает aiohttp-приложение и работает до отмены задачи.
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(
+        dispatcher: Dispatcher, bot: Bot, url, path, host, port,
+        secret_token=None):
+    """
+    Регистрирует вебхук в Telegram и обрабатывает обновления через
+    встроенный aiohttp-сервер вместо long polling.
+    """
+    # Без заданного секрета генерируем случайный: вебхук все равно
+    # регистрируется заново при каждом запуске
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    handler = WebhookHandler(dispatcher, bot, secret_token)
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+
+    await dispatcher.emit_startup(bot=bot)
+    await bot.set_webhook(
+        url=url.rstrip('/') + path,
+        secret_token=secret_token,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        drop_pending_updates=True)
+    logging.info(f"Вебхук слушает {host}:{port}{path}")
+    try:
+        await serve_app(app, host, port)
+    finally:
+        await handler.wait_closed()
+        await dispatcher.emit_shutdown(bot=bot)
+        await bot.session.close()